@@ -13,10 +13,14 @@ Proceedings of the 54th Annual Meeting of the Association for Computational Ling
 
 from __future__ import unicode_literals, division
 
+import os
 import sys
 import codecs
+import pickle
+import hashlib
 import argparse
-from collections import defaultdict
+from multiprocessing import Pool
+from collections import defaultdict, OrderedDict
 
 # hack for python2/3 compatibility
 from io import open
@@ -28,21 +32,49 @@ if sys.version_info < (3, 0):
   sys.stdout = codecs.getwriter('UTF-8')(sys.stdout)
   sys.stdin = codecs.getreader('UTF-8')(sys.stdin)
 
+class LRUCache(object):
+    """Dictionary which holds at most `size` items, and evicts the least recently used ones"""
+
+    def __init__(self, size):
+        self.size = size
+        self.items = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __getitem__(self, key):
+        value = self.items.pop(key)
+        self.items[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self.items.pop(key, None)
+        self.items[key] = value
+        if len(self.items) > self.size:
+            self.items.popitem(last=False)
+
 class BPE(object):
 
-    def __init__(self, codes, separator='@@'):
+    def __init__(self, codes, separator='@@', cache_size=100000):
+        codes = list(codes)
+        self.codes_hash = hashlib.md5(''.join(codes).encode('utf-8')).hexdigest()
         self.bpe_codes = [tuple(item.split()) for item in codes]
         # some hacking to deal with duplicates (only consider first instance)
         self.bpe_codes = dict([(code,i) for (i,code) in reversed(list(enumerate(self.bpe_codes)))])
 
         self.separator = separator
+        # precomputed segmentations (e.g., of the training vocabulary), and cache for the other words
+        self.table = {}
+        self.cache = LRUCache(cache_size)
 
     def segment(self, sentence):
         """segment single sentence (whitespace-tokenized string) with BPE encoding"""
 
         output = []
         for word in sentence.split():
-            new_word = encode(word, self.bpe_codes)
+            new_word = self.table.get(word)
+            if new_word is None:
+                new_word = encode(word, self.bpe_codes, self.cache)
 
             for item in new_word[:-1]:
                 output.append(item + self.separator)
@@ -50,6 +82,30 @@ class BPE(object):
 
         return ' '.join(output)
 
+    def build_table(self, words):
+        """precompute the segmentation of these words"""
+        for word in words:
+            if word not in self.table:
+                self.table[word] = encode(word, self.bpe_codes)
+
+    def save_table(self, filename):
+        with open(filename, 'wb') as f:
+            pickle.dump({'codes_hash': self.codes_hash, 'table': self.table}, f, protocol=2)
+
+    def load_table(self, filename):
+        """load a segmentation table, unless it does not exist or was created with different codes
+
+        return True if the table was loaded
+        """
+        if not os.path.exists(filename):
+            return False
+        with open(filename, 'rb') as f:
+            content = pickle.load(f)
+        if content['codes_hash'] != self.codes_hash:
+            return False
+        self.table = content['table']
+        return True
+
 def create_parser():
     parser = argparse.ArgumentParser(
         formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -70,6 +126,16 @@ def create_parser():
     parser.add_argument(
         '--separator', '-s', type=str, default='@@', metavar='STR',
         help="Separator between non-final subword units (default: '%(default)s'))")
+    parser.add_argument(
+        '--table', '-t', metavar='PATH',
+        help="Segmentation table of the vocabulary. If this file does not exist (or was created with other codes), "
+             "it is created from the vocabulary of the input file (which cannot be standard input).")
+    parser.add_argument(
+        '--cache-size', type=int, default=100000,
+        help="Maximum number of words whose segmentation is cached (besides those in the table) (default: %(default)s)")
+    parser.add_argument(
+        '--processes', '-p', type=int, default=1,
+        help="Number of processes which segment the input in parallel (default: %(default)s)")
 
     return parser
 
@@ -85,11 +151,11 @@ def get_pairs(word):
         prev_char = char
     return pairs
 
-def encode(orig, bpe_codes, cache={}):
+def encode(orig, bpe_codes, cache=None):
     """Encode word based on list of BPE merge operations, which are applied consecutively
     """
 
-    if orig in cache:
+    if cache is not None and orig in cache:
         return cache[orig]
 
     word = tuple(orig) + ('</w>',)
@@ -130,16 +196,51 @@ def encode(orig, bpe_codes, cache={}):
     elif word[-1].endswith('</w>'):
         word = word[:-1] + (word[-1].replace('</w>',''),)
 
-    cache[orig] = word
+    if cache is not None:
+        cache[orig] = word
     return word
 
 
+def get_vocabulary(fobj):
+    """Read text and return the set of its words"""
+    vocab = set()
+    for line in fobj:
+        vocab.update(line.split())
+    return vocab
+
+bpe = None
+
+def init_worker(bpe_):
+    global bpe
+    bpe = bpe_
+
+def segment_line(line):
+    return bpe.segment(line).strip()
+
+
 if __name__ == '__main__':
     parser = create_parser()
     args = parser.parse_args()
 
-    bpe = BPE(args.codes, args.separator)
-
-    for line in args.input:
-        args.output.write(bpe.segment(line).strip())
-        args.output.write('\n')
+    bpe = BPE(args.codes, args.separator, args.cache_size)
+
+    if args.table and not bpe.load_table(args.table):
+        if args.input is sys.stdin:
+            parser.error('cannot create the segmentation table from standard input')
+        bpe.build_table(get_vocabulary(args.input))
+        bpe.save_table(args.table)
+        args.input.seek(0)
+
+    if args.processes > 1:
+        pool = Pool(args.processes, initializer=init_worker, initargs=(bpe,))
+        try:
+            lines = pool.imap(segment_line, args.input, chunksize=1000)
+            for line in lines:
+                args.output.write(line)
+                args.output.write('\n')
+        finally:
+            pool.close()
+    else:
+        for line in args.input:
+            args.output.write(segment_line(line))
+            args.output.write('\n')
@@ -7,16 +7,14 @@ import yaafelib
 import struct
 import sys
 from collections import Counter
+from multiprocessing import Pool
 
 parser = argparse.ArgumentParser()
 parser.add_argument('filenames', nargs='*', help='audio filenames corresponding to one line each')
 parser.add_argument('--output', dest='output_file', help='output file')
 parser.add_argument('--derivatives', action='store_true')
-
-args = parser.parse_args()
-
-if not args.filenames:
-    args.filenames = [filename.strip() for filename in sys.stdin]
+parser.add_argument('--processes', type=int, default=1, help='number of worker processes (each one with its own '
+                    'yaafe engine)')
 
 parameters = dict(
     step_size=160,  # corresponds to 10 ms (at 16 kHz)
@@ -25,52 +23,88 @@ parameters = dict(
     mfcc_filters=41  # more filters? (needs to be at least mfcc_coeffs+1, because first coeff is ignored)
 )
 
-# TODO: ensure that all input files use this rate
-fp = yaafelib.FeaturePlan(sample_rate=16000)
+engine = None
+afp = None
+keys = None
+
+
+def init_worker(derivatives):
+    """
+    Create the yaafe engine of this process
+    """
+    global engine, afp, keys
+
+    # TODO: ensure that all input files use this rate
+    fp = yaafelib.FeaturePlan(sample_rate=16000)
+
+    mfcc_features = 'MFCC MelNbFilters={mfcc_filters} CepsNbCoeffs={mfcc_coeffs} ' \
+                    'blockSize={block_size} stepSize={step_size}'.format(**parameters)
+    energy_features = 'Energy blockSize={block_size} stepSize={step_size}'.format(**parameters)
+
+    fp.addFeature('mfcc: {}'.format(mfcc_features))
+    if derivatives:
+        fp.addFeature('mfcc_d1: {} > Derivate DOrder=1'.format(mfcc_features))
+        fp.addFeature('mfcc_d2: {} > Derivate DOrder=2'.format(mfcc_features))
+
+    fp.addFeature('energy: {}'.format(energy_features))
+    if derivatives:
+        fp.addFeature('energy_d1: {} > Derivate DOrder=1'.format(energy_features))
+        fp.addFeature('energy_d2: {} > Derivate DOrder=2'.format(energy_features))
+
+    if derivatives:
+        keys = ['mfcc', 'mfcc_d1', 'mfcc_d2', 'energy', 'energy_d1', 'energy_d2']
+    else:
+        keys = ['mfcc', 'energy']
+
+    df = fp.getDataFlow()
+    engine = yaafelib.Engine()
+    engine.load(df)
+
+    afp = yaafelib.AudioFileProcessor()
 
-mfcc_features = 'MFCC MelNbFilters={mfcc_filters} CepsNbCoeffs={mfcc_coeffs} ' \
-                'blockSize={block_size} stepSize={step_size}'.format(**parameters)
-energy_features = 'Energy blockSize={block_size} stepSize={step_size}'.format(**parameters)
 
-fp.addFeature('mfcc: {}'.format(mfcc_features))
-if args.derivatives:
-    fp.addFeature('mfcc_d1: {} > Derivate DOrder=1'.format(mfcc_features))
-    fp.addFeature('mfcc_d2: {} > Derivate DOrder=2'.format(mfcc_features))
+def extract_features(filename):
+    afp.processFile(engine, filename)
+    feats_ = engine.readAllOutputs()
+    feats = np.concatenate([feats_[k] for k in keys], axis=1)
+    return feats.astype(np.float32)
 
-fp.addFeature('energy: {}'.format(energy_features))
-if args.derivatives:
-    fp.addFeature('energy_d1: {} > Derivate DOrder=1'.format(energy_features))
-    fp.addFeature('energy_d2: {} > Derivate DOrder=2'.format(energy_features))
 
-if args.derivatives:
-    keys = ['mfcc', 'mfcc_d1', 'mfcc_d2', 'energy', 'energy_d1', 'energy_d2']
-else:
-    keys = ['mfcc', 'energy']
+if __name__ == '__main__':
+    args = parser.parse_args()
 
-df = fp.getDataFlow()
-engine = yaafelib.Engine()
-engine.load(df)
+    if not args.filenames:
+        args.filenames = [filename.strip() for filename in sys.stdin]
 
-afp = yaafelib.AudioFileProcessor()
+    frame_counter = Counter()
 
-frame_counter = Counter()
+    if args.processes > 1:
+        pool = Pool(args.processes, initializer=init_worker, initargs=(args.derivatives,))
+        # `imap` returns the features in the same order as the filenames
+        all_feats = pool.imap(extract_features, args.filenames, chunksize=16)
+    else:
+        pool = None
+        init_worker(args.derivatives)
+        all_feats = (extract_features(filename) for filename in args.filenames)
 
-with open(args.output_file, 'wb') as f:
-    for i, filename in enumerate(args.filenames):
-        afp.processFile(engine, filename)
-        feats_ = engine.readAllOutputs()
-        feats = np.concatenate([feats_[k] for k in keys], axis=1)
-        frames, dim = feats.shape
-        frame_counter[frames] += 1
-        feats = feats.flatten()
+    try:
+        with open(args.output_file, 'wb') as f:
+            for i, feats in enumerate(all_feats):
+                filename = args.filenames[i]
+                frames, dim = feats.shape
+                frame_counter[frames] += 1
 
-        if frames == 0:
-            print(frames, dim, filename)
-            raise Exception
+                if frames == 0:
+                    print(frames, dim, filename)
+                    raise Exception
 
-        if i == 0:  # write header
-            f.write(struct.pack('ii', len(args.filenames), dim))
-        f.write(struct.pack('i' + 'f' * len(feats), frames, *feats))
+                if i == 0:  # write header
+                    f.write(struct.pack('ii', len(args.filenames), dim))
+                f.write(struct.pack('i', frames))
+                f.write(feats.tobytes())
+    finally:
+        if pool is not None:
+            pool.terminate()
 
 
 def read_features(filename):
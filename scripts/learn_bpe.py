@@ -16,8 +16,9 @@ from __future__ import unicode_literals
 import sys
 import codecs
 import re
-import copy
+import heapq
 import argparse
+from multiprocessing import Pool
 from collections import defaultdict, Counter
 
 # hack for python2/3 compatibility
@@ -49,6 +50,9 @@ def create_parser():
     parser.add_argument(
         '--verbose', '-v', action="store_true",
         help="verbose mode.")
+    parser.add_argument(
+        '--processes', '-p', type=int, default=1,
+        help="Number of processes used to count the initial symbol pairs (default: %(default)s)")
 
     return parser
 
@@ -66,11 +70,13 @@ def update_pair_statistics(pair, changed, stats, indices):
 
     if we merge a pair of symbols, only pairs that overlap with occurrences
     of this pair are affected, and need to be updated.
+    Return the pairs whose frequency changed (in order of first update).
     """
     stats[pair] = 0
     indices[pair] = defaultdict(int)
     first, second = pair
     new_pair = first+second
+    updated = []
     for j, word, old_word, freq in changed:
 
         # find all instances of pair, and update frequency/indices around it
@@ -85,12 +91,14 @@ def update_pair_statistics(pair, changed, stats, indices):
                     prev = old_word[i-1:i+1]
                     stats[prev] -= freq
                     indices[prev][j] -= 1
+                    updated.append(prev)
                 if i < len(old_word)-2:
                     # don't double-count consecutive pairs
                     if old_word[i+2] != first or i >= len(old_word)-3 or old_word[i+3] != second:
                         nex = old_word[i+1:i+3]
                         stats[nex] -= freq
                         indices[nex][j] -= 1
+                        updated.append(nex)
                 i += 2
             else:
                 i += 1
@@ -105,30 +113,63 @@ def update_pair_statistics(pair, changed, stats, indices):
                 prev = word[i-1:i+1]
                 stats[prev] += freq
                 indices[prev][j] += 1
+                updated.append(prev)
             # don't double-count consecutive pairs
             if i < len(word)-1 and word[i+1] != new_pair:
                 nex = word[i:i+2]
                 stats[nex] += freq
                 indices[nex][j] += 1
+                updated.append(nex)
             i += 1
 
+    return updated
 
-def get_pair_statistics(vocab):
-    """Count frequency of all symbol pairs, and create index"""
 
-    # data structure of pair frequencies
+def count_pairs(args):
+    """Count frequency of the symbol pairs in a slice of the vocabulary, starting at index `offset`"""
+    vocab, offset = args
     stats = defaultdict(int)
+    indices = defaultdict(dict)
 
-    #index from pairs to words
-    indices = defaultdict(lambda: defaultdict(int))
-
-    for i, (word, freq) in enumerate(vocab):
+    for i, (word, freq) in enumerate(vocab, offset):
         prev_char = word[0]
         for char in word[1:]:
             stats[prev_char, char] += freq
-            indices[prev_char, char][i] += 1
+            indices[prev_char, char][i] = indices[prev_char, char].get(i, 0) + 1
             prev_char = char
 
+    return dict(stats), dict(indices)
+
+
+def get_pair_statistics(vocab, processes=1):
+    """Count frequency of all symbol pairs, and create index
+
+    With several processes, the vocabulary is split into slices which are counted in parallel,
+    and merged in vocabulary order.
+    """
+
+    # data structure of pair frequencies
+    stats = defaultdict(int)
+
+    #index from pairs to words
+    indices = defaultdict(lambda: defaultdict(int))
+
+    if processes > 1:
+        size = -(-len(vocab) // (4 * processes))
+        slices = [(vocab[i:i+size], i) for i in range(0, len(vocab), size)]
+        pool = Pool(processes)
+        try:
+            counts = pool.map(count_pairs, slices)
+        finally:
+            pool.close()
+    else:
+        counts = [count_pairs((vocab, 0))]
+
+    for slice_stats, slice_indices in counts:
+        for pair, freq in slice_stats.items():
+            stats[pair] += freq
+            indices[pair].update(slice_indices[pair])
+
     return stats, indices
 
 
@@ -154,22 +195,29 @@ def replace_pair(pair, vocab, indices):
         vocab[j] = (new_word, freq)
         changes.append((j, new_word, word, freq))
 
+    # sort by word index, so that the order of new pairs does not depend on dict ordering
+    changes.sort(key=lambda change: change[0])
     return changes
 
-def prune_stats(stats, big_stats, threshold):
-    """Prune statistics dict for efficiency of max()
+def push_pairs(heap, pairs, stats, order):
+    """Push the current frequency of these pairs on the heap
 
-    The frequency of a symbol pair never increases, so pruning is generally safe
-    (until we the most frequent pair is less frequent than a pair we previously pruned)
-    big_stats keeps full statistics for when we need to access pruned items
+    Entries with an outdated frequency are not removed from the heap, but skipped by `pop_most_frequent`.
+    Pairs with the same frequency are sorted by order of creation.
     """
-    for item,freq in list(stats.items()):
-        if freq < threshold:
-            del stats[item]
-            if freq < 0:
-                big_stats[item] += freq
-            else:
-                big_stats[item] = freq
+    seen = set()
+    for pair in pairs:
+        if stats[pair] > 0 and pair not in seen:
+            seen.add(pair)
+            heapq.heappush(heap, (-stats[pair], order.setdefault(pair, len(order)), pair))
+
+def pop_most_frequent(heap, stats):
+    """Pop the most frequent pair from the heap, or return None if the heap is empty"""
+    while heap:
+        freq, _, pair = heapq.heappop(heap)
+        if -freq == stats[pair]:
+            return pair
+    return None
 
 if __name__ == '__main__':
 
@@ -180,24 +228,19 @@ if __name__ == '__main__':
     vocab = dict([(tuple(x)+('</w>',) ,y) for (x,y) in vocab.items()])
     sorted_vocab = sorted(vocab.items(), key=lambda x: x[1], reverse=True)
 
-    stats, indices = get_pair_statistics(sorted_vocab)
-    big_stats = copy.deepcopy(stats)
-    # threshold is inspired by Zipfian assumption, but should only affect speed
-    threshold = max(stats.values()) / 10
+    stats, indices = get_pair_statistics(sorted_vocab, args.processes)
+    # ties are broken by order of first occurrence in the vocabulary (regardless of dict ordering)
+    order = {}
+    for word, _ in sorted_vocab:
+        for pair in zip(word, word[1:]):
+            order.setdefault(pair, len(order))
+    heap = []
+    push_pairs(heap, sorted(order, key=order.get), stats, order)
+
     for i in range(args.symbols):
-        if stats:
-            most_frequent = max(stats, key=stats.get)
-
-        # we probably missed the best pair because of pruning; go back to full statistics
-        if not stats or (i and stats[most_frequent] < threshold):
-            prune_stats(stats, big_stats, threshold)
-            stats = copy.deepcopy(big_stats)
-            most_frequent = max(stats, key=stats.get)
-            # threshold is inspired by Zipfian assumption, but should only affect speed
-            threshold = stats[most_frequent] * i/(i+10000.0)
-            prune_stats(stats, big_stats, threshold)
-
-        if stats[most_frequent] < 2:
+        most_frequent = pop_most_frequent(heap, stats)
+
+        if most_frequent is None or stats[most_frequent] < 2:
             sys.stderr.write('no pair has frequency > 1. Stopping\n')
             break
 
@@ -205,7 +248,6 @@ if __name__ == '__main__':
             sys.stderr.write('pair {0}: {1} {2} -> {1}{2} (frequency {3})\n'.format(i, most_frequent[0], most_frequent[1], stats[most_frequent]))
         args.output.write('{0} {1}\n'.format(*most_frequent))
         changes = replace_pair(most_frequent, sorted_vocab, indices)
-        update_pair_statistics(most_frequent, changes, stats, indices)
+        updated = update_pair_statistics(most_frequent, changes, stats, indices)
         stats[most_frequent] = 0
-        if not i % 100:
-            prune_stats(stats, big_stats, threshold)
+        push_pairs(heap, updated, stats, order)
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Pack a list of feature files (one path per line, each file containing a single entry, as
+created by `scripts/extract-audio-features.py`) into a single binary feature file, and
+write its index (position and number of frames of each entry).
+
+The packed file has the same format as the files created by `scripts/extract-audio-features.py`.
+By default, it is written to `LIST_FILE.bin`, where it is found by the training and evaluation
+code, which memory-maps it instead of opening and decoding one file per utterance.
+
+Usage example:
+    scripts/pack-audio-features.py experiments/ted_speech/data/train.feats41
+"""
+import struct
+import argparse
+from array import array
+
+parser = argparse.ArgumentParser()
+parser.add_argument('input', help='file containing the list of feature files')
+parser.add_argument('output', nargs='?', help='packed feature file (default: INPUT.bin)')
+
+args = parser.parse_args()
+output_filename = args.output or '{}.bin'.format(args.input)
+
+with open(args.input) as input_file:
+    filenames = [line.strip() for line in input_file]
+
+index = array('q')  # position (in number of floats) and number of frames of each entry
+
+with open(output_filename, 'wb') as output_file:
+    dim = None
+    offset = 8
+
+    for filename in filenames:
+        with open(filename, 'rb') as input_file:
+            lines_, dim_ = struct.unpack('ii', input_file.read(8))
+            if dim is None:
+                dim = dim_
+                output_file.write(struct.pack('ii', len(filenames), dim))
+            elif dim_ != dim:
+                raise Exception('incompatible dimensions')
+
+            # only the first entry of each file is used (same as `read_binary_features_list`)
+            x = input_file.read(4)
+            frames, = struct.unpack('i', x)
+
+            output_file.write(x)
+            output_file.write(input_file.read(4 * frames * dim))
+
+            offset += 4
+            index.extend([offset // 4, frames])
+            offset += 4 * frames * dim
+
+    if dim is None:  # empty list
+        output_file.write(struct.pack('ii', 0, 0))
+
+with open('{}.idx'.format(output_filename), 'wb') as index_file:
+    index.tofile(index_file)
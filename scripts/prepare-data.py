@@ -1,8 +1,11 @@
 #!/usr/bin/env python3
 from itertools import islice
-from random import shuffle
-from contextlib import contextmanager
+from random import shuffle, randrange
+from contextlib import contextmanager, ExitStack
 from collections import Counter
+from functools import partial
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 import argparse
 import subprocess
 import tempfile
@@ -11,6 +14,7 @@ import logging
 import sys
 import shutil
 import codecs
+import hashlib
 
 
 help_msg = """\
@@ -82,18 +86,66 @@ def read_vocabulary(filename):
         return dict(map(reversed, enumerate(words)))
 
 
-def create_vocabulary(filename, output_filename, size, character_level=False, min_count=1):
-    logging.info('creating vocabulary {} from {}'.format(output_filename,
-                                                         filename))
-    vocab = Counter()
-    with open(filename) as input_file, \
-         open(output_filename, 'w') as output_file:
-        for line in input_file:
-            line = line.strip() if character_level else line.split()
+def file_chunks(filename, chunks):
+    """
+    Split a file into (roughly) `chunks` byte ranges
+    """
+    size = os.path.getsize(filename)
+    chunk_size = max(1, -(-size // chunks))
+    return [(start, min(start + chunk_size, size)) for start in range(0, size, chunk_size)]
 
-            for w in line:
-                vocab[w] += 1
 
+def count_tokens(filename, start, end, character_level=False):
+    """
+    Count the tokens of the lines which start in the byte range [start, end) of a file
+    """
+    vocab = Counter()
+    with open(filename, 'rb') as input_file:
+        if start > 0:
+            input_file.seek(start - 1)
+            input_file.readline()  # skip the end of the line which started in the previous range
+
+        while input_file.tell() < end:
+            line = input_file.readline()
+            if not line:
+                break
+            line = line.decode()
+            vocab.update(line.strip() if character_level else line.split())
+
+    return vocab
+
+
+def _count_tokens(args):
+    return count_tokens(*args)
+
+
+def create_vocabularies(filenames, output_filenames, sizes, character_levels, min_counts, processes=1):
+    """
+    Create the vocabularies of several files at once. The files are split into byte ranges,
+    whose tokens are counted in parallel. Partial counts are merged in file order, so that
+    words with the same count are sorted by order of first occurrence.
+    """
+    for filename, output_filename in zip(filenames, output_filenames):
+        logging.info('creating vocabulary {} from {}'.format(output_filename, filename))
+
+    jobs = [
+        (i, (filename, start, end, character_level))
+        for i, (filename, character_level) in enumerate(zip(filenames, character_levels))
+        for start, end in file_chunks(filename, 4 * processes)
+    ]
+
+    vocabs = [Counter() for _ in filenames]
+    if processes > 1:
+        with Pool(processes) as pool:
+            counts = pool.imap(_count_tokens, [args for _, args in jobs])  # same order as `jobs`
+            for (i, _), count in zip(jobs, counts):
+                vocabs[i].update(count)
+    else:
+        for i, args in jobs:
+            vocabs[i].update(_count_tokens(args))
+
+    vocab_dicts = []
+    for vocab, output_filename, size, min_count in zip(vocabs, output_filenames, sizes, min_counts):
         if min_count > 1:
             vocab = {w: c for (w, c) in vocab.items() if c >= min_count}
 
@@ -101,44 +153,53 @@ def create_vocabulary(filename, output_filename, size, character_level=False, mi
         if 0 < size < len(vocab_list):
             vocab_list = vocab_list[:size]
 
-        output_file.writelines(w + '\n' for w in vocab_list)
+        with open(output_filename, 'w') as output_file:
+            output_file.writelines(w + '\n' for w in vocab_list)
 
-    return dict(map(reversed, enumerate(vocab_list)))
+        vocab_dicts.append(dict(map(reversed, enumerate(vocab_list))))
 
+    return vocab_dicts
 
-def process_file(filename, lang, ext, args):
-    logging.info('processing ' + filename)
 
-    with open_temp_files(num=1) as output_, open(filename) as input_:
-        output_, = output_
+def create_vocabulary(filename, output_filename, size, character_level=False, min_count=1, processes=1):
+    return create_vocabularies([filename], [output_filename], [size], [character_level], [min_count],
+                               processes=processes)[0]
 
-        def path_to(script_name):
-            if args.scripts is None:
-                return script_name   # assume script is in PATH
-            else:
-                return os.path.join(args.scripts, script_name)
-
-        processes = [['cat']]   # just copy file if there is no other operation
-
-        if ext in args.unescape_special_chars:
-            processes.append([path_to('unescape-special-chars.perl')])
-        if ext in args.normalize_punk:
-            processes.append([path_to('normalize-punctuation.perl'), '-l',
-                              lang])
-        if args.normalize_moses:
-            processes.append(['sed', 's/|//g'])
-        if ext in args.subwords:
-            processes.append(['sed', 's/@\\+/@/g'])  # @@ is used as delimiter for subwords
-        if ext not in args.no_tokenize:
-            processes.append([path_to('tokenizer.perl'), '-l', lang, '-threads',
-                              str(args.threads)])
-        if ext in args.lowercase:
-            processes.append([path_to('lowercase.perl')])
-        if ext in args.normalize_digits:
-            processes.append(['sed', 's/[[:digit:]]/0/g'])
-        if ext in args.escape_special_chars:
-            processes.append([path_to('escape-special-chars.perl')])
 
+def pipeline_commands(lang, ext, args, threads=None):
+    def path_to(script_name):
+        if args.scripts is None:
+            return script_name   # assume script is in PATH
+        else:
+            return os.path.join(args.scripts, script_name)
+
+    processes = [['cat']]   # just copy file if there is no other operation
+
+    if ext in args.unescape_special_chars:
+        processes.append([path_to('unescape-special-chars.perl')])
+    if ext in args.normalize_punk:
+        processes.append([path_to('normalize-punctuation.perl'), '-l',
+                          lang])
+    if args.normalize_moses:
+        processes.append(['sed', 's/|//g'])
+    if ext in args.subwords:
+        processes.append(['sed', 's/@\\+/@/g'])  # @@ is used as delimiter for subwords
+    if ext not in args.no_tokenize:
+        processes.append([path_to('tokenizer.perl'), '-l', lang, '-threads',
+                          str(threads or args.threads)])
+    if ext in args.lowercase:
+        processes.append([path_to('lowercase.perl')])
+    if ext in args.normalize_digits:
+        processes.append(['sed', 's/[[:digit:]]/0/g'])
+    if ext in args.escape_special_chars:
+        processes.append([path_to('escape-special-chars.perl')])
+
+    return processes
+
+
+def run_pipeline(processes, filename):
+    with open_temp_files(num=1) as output_, open(filename) as input_:
+        output_, = output_
         ps = None
 
         for i, process in enumerate(processes):
@@ -152,6 +213,49 @@ def process_file(filename, lang, ext, args):
         return output_.name
 
 
+def split_file(filename, shard_size):
+    """
+    Split a file into shards of `shard_size` lines (temporary files)
+    """
+    shards = []
+    with open(filename) as input_:
+        while True:
+            lines = list(islice(input_, shard_size))
+            if not lines:
+                break
+            with open_temp_files(num=1) as output_:
+                output_[0].writelines(lines)
+                shards.append(output_[0].name)
+
+    return shards
+
+
+def process_file(filename, lang, ext, args):
+    logging.info('processing ' + filename)
+
+    if args.processes <= 1:
+        return run_pipeline(pipeline_commands(lang, ext, args), filename)
+
+    # the file is split into shards, which are processed in parallel (the work is done by
+    # external processes, so threads are enough), and the results are concatenated in order
+    threads = max(1, args.threads // args.processes)
+    processes = pipeline_commands(lang, ext, args, threads=threads)
+    shards = split_file(filename, args.shard_size)
+
+    with ThreadPool(args.processes) as pool:
+        output_shards = pool.map(partial(run_pipeline, processes), shards)
+
+    with open_temp_files(num=1) as output_:
+        output_, = output_
+        for shard in output_shards:
+            with open(shard) as shard_file:
+                shutil.copyfileobj(shard_file, output_)
+            os.remove(shard)
+        for shard in shards:
+            os.remove(shard)
+        return output_.name
+
+
 def filter_corpus(filenames, args):
     with open_files(filenames) as input_files, \
          open_temp_files(len(filenames)) as output_files:
@@ -164,6 +268,74 @@ def filter_corpus(filenames, args):
         return [f.name for f in output_files]
 
 
+def line_hash(line):
+    return hashlib.md5(line.encode()).digest()[:8]
+
+
+def remove_duplicate_lines(all_lines, n):
+    """
+    Remove any tuple of lines whose lines were already seen on the same side
+    (only the hashes of the lines are kept in memory)
+    """
+    seen_lines = [set() for _ in range(n)]
+    for line_tuple in all_lines:
+        hashes = [line_hash(line) for line in line_tuple]
+        if not any(hash_ in seen_lines_ for hash_, seen_lines_ in zip(hashes, seen_lines)):
+            yield line_tuple
+        # the lines of dropped tuples also count as seen
+        for hash_, seen_lines_ in zip(hashes, seen_lines):
+            seen_lines_.add(hash_)
+
+
+def remove_duplicates(all_lines):
+    """
+    Remove duplicate tuples of lines (first occurrence is kept)
+    """
+    seen = set()
+    for line_tuple in all_lines:
+        hash_ = line_hash('\0'.join(line_tuple))
+        if hash_ not in seen:
+            seen.add(hash_)
+            yield line_tuple
+
+
+def shuffle_lines(all_lines, n, buckets=1):
+    """
+    Shuffle tuples of lines. When `buckets` is larger than 1, the tuples are distributed at random
+    into this number of temporary files, which are then shuffled one at a time, so that only one
+    bucket at a time needs to fit in memory.
+    """
+    if buckets <= 1:
+        all_lines = list(all_lines)
+        shuffle(all_lines)
+        yield from all_lines
+        return
+
+    bucket_files = []
+    try:
+        for _ in range(buckets):
+            with open_temp_files(n) as files:
+                bucket_files.append([f.name for f in files])
+
+        with ExitStack() as stack:
+            files = [[stack.enter_context(open(name, 'w')) for name in names] for names in bucket_files]
+            for line_tuple in all_lines:
+                for line, file_ in zip(line_tuple, files[randrange(buckets)]):
+                    file_.write(line)
+
+        for names in bucket_files:
+            with open_files(names) as files:
+                lines = list(zip(*files))
+            shuffle(lines)
+            yield from lines
+    finally:
+        for name in sum(bucket_files, []):
+            try:
+                os.remove(name)
+            except OSError:
+                pass
+
+
 def process_corpus(filenames, args):
     filenames = [process_file(filename, lang, ext, args)
         for lang, ext, filename in zip(args.lang, args.extensions, filenames)]
@@ -177,19 +349,12 @@ def process_corpus(filenames, args):
                          in zip(lines, args.min, args.max)))
 
         if args.remove_duplicate_lines:
-            seen_lines = [set() for _ in filenames]
-            lines = []
-            for line_tuple in all_lines:
-                if not any(line in seen_lines_ for line, seen_lines_ in
-                           zip(line_tuple, seen_lines)):
-                    lines.append(line_tuple)
-            all_lines = lines
+            all_lines = remove_duplicate_lines(all_lines, len(filenames))
         elif args.remove_duplicates:
-            all_lines = list(set(all_lines))
+            all_lines = remove_duplicates(all_lines)
 
         if args.shuffle:
-            all_lines = list(all_lines)  # not lazy anymore
-            shuffle(all_lines)
+            all_lines = shuffle_lines(all_lines, len(filenames), args.shuffle_buckets)
 
         for lines in all_lines:  # keeps it lazy if no shuffle
             for line, output_file in zip(lines, output_files):
@@ -222,10 +387,11 @@ def create_subwords(filename, output_filename, size):
     subprocess.call(cmd)
 
 
-def apply_subwords(filename, bpe_filename):
+def apply_subwords(filename, bpe_filename, processes=1):
     with open_temp_files(num=1) as output_:
         output_, = output_
-        cmd = ['scripts/apply_bpe.py', '--input', filename, '--codes', bpe_filename]
+        cmd = ['scripts/apply_bpe.py', '--input', filename, '--codes', bpe_filename,
+               '--processes', str(processes)]
         subprocess.call(cmd, stdout=output_)
 
         return output_.name
@@ -279,7 +445,7 @@ def process_corpora(args, corpora, output_corpora, sizes):
                 continue
 
             filenames = [
-                apply_subwords(filename, bpe_filename) if ext in args.subwords else filename
+                apply_subwords(filename, bpe_filename, args.processes) if ext in args.subwords else filename
                 for ext, filename, bpe_filename in zip(args.extensions, corpus, bpe_filenames)
             ]
 
@@ -316,13 +482,9 @@ def process_vocabularies(args, corpora):
     # training corpus is used to create vocabulary
     train_corpus = corpora[-1]
 
-    for filename, output_filename, size, ext, min_count in zip(train_corpus,
-                                                               vocab_output_filenames,
-                                                               args.vocab_size,
-                                                               args.extensions,
-                                                               args.min_count):
-        character_level = ext in args.character_level
-        create_vocabulary(filename, output_filename, size, character_level, min_count)
+    character_levels = [ext in args.character_level for ext in args.extensions]
+    create_vocabularies(train_corpus, vocab_output_filenames, args.vocab_size, character_levels,
+                        args.min_count, processes=args.processes)
 
 
 if __name__ == '__main__':
@@ -399,6 +561,11 @@ if __name__ == '__main__':
     parser.add_argument('--min-count', nargs='+', type=int, help='minimum count words in vocabulary', default=[1])
     parser.add_argument('--vocab-path', help='path to existing vocabularies (corpus prefix)')
     parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--processes', type=int, default=1, help='number of shards of each file '
+                        'that are pre-processed in parallel (also used for counting words)')
+    parser.add_argument('--shard-size', type=int, default=100000, help='number of lines per shard')
+    parser.add_argument('--shuffle-buckets', type=int, default=1, help='shuffle the corpus in this '
+                        'number of buckets (temporary files), for corpora that do not fit in memory')
 
     args = parser.parse_args()
 
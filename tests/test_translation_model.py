@@ -0,0 +1,32 @@
+import os
+import glob
+import tempfile
+import unittest
+import numpy as np
+
+try:
+    import tensorflow as tf
+    from translate.translation_model import BackgroundSaver
+except ImportError:
+    tf = None
+
+
+@unittest.skipIf(tf is None, 'requires TensorFlow')
+class BackgroundSaverTest(unittest.TestCase):
+    def test_numpy_step(self):
+        checkpoint_dir = tempfile.mkdtemp()
+
+        with tf.Graph().as_default():
+            var = tf.Variable(np.arange(4, dtype=np.float32), name='var')
+            with tf.Session() as sess:
+                sess.run(tf.initialize_all_variables())
+                saver = BackgroundSaver([var])
+                # `MultiTaskModel.global_step` used to be a numpy integer
+                saver.save(sess, os.path.join(checkpoint_dir, 'translate'), global_step=np.int32(5))
+                saver.wait()
+
+        self.assertTrue(glob.glob(os.path.join(checkpoint_dir, 'translate-5*')))
+
+
+if __name__ == '__main__':
+    unittest.main()
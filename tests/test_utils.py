@@ -0,0 +1,99 @@
+import os
+import json
+import struct
+import subprocess
+import sys
+import tempfile
+import unittest
+import numpy as np
+
+from translate import utils
+
+
+class TokenBatchTest(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(1234)
+        lengths = np.random.randint(1, 300, size=2000)
+        lengths[:5] = 3000  # longer than the budget
+        self.data = [[np.zeros(length), np.zeros(length // 2 + 1)] for length in lengths]
+        self.lengths = np.sort(lengths)
+        self.batch_tokens = 1000
+
+    def test_split_token_batches(self):
+        boundaries = utils.split_token_batches(self.lengths, self.batch_tokens)
+
+        self.assertEqual(boundaries[0][0], 0)
+        self.assertEqual(boundaries[-1][1], len(self.lengths))
+
+        for (start, end), (next_start, _) in zip(boundaries, boundaries[1:] + [(len(self.lengths), None)]):
+            self.assertEqual(end, next_start)
+            size = end - start
+            # never exceeds the budget (except for examples that are too long on their own)
+            self.assertTrue(size == 1 or size * self.lengths[end - 1] <= self.batch_tokens)
+            # filled to the budget: adding the next example would exceed it
+            if end < len(self.lengths):
+                self.assertGreater((size + 1) * self.lengths[end], self.batch_tokens)
+
+    def test_token_batch_iterator(self):
+        batches = len(utils.split_token_batches(self.lengths, self.batch_tokens))
+        iterator = utils.token_batch_iterator(self.data, self.batch_tokens)
+
+        examples = 0
+        for _ in range(batches):  # one epoch
+            batch = next(iterator)
+            max_len = max(len(input_) for inputs in batch for input_ in inputs)
+            self.assertTrue(len(batch) == 1 or len(batch) * max_len <= self.batch_tokens)
+            examples += len(batch)
+
+        self.assertEqual(examples, len(self.data))
+
+
+class MetricsTest(unittest.TestCase):
+    def test_numpy_values(self):
+        metrics_file = os.path.join(tempfile.mkdtemp(), 'metrics.jsonl')
+        utils.write_metrics(metrics_file, event='save', step=np.int32(500) + np.int32(500), time=np.float32(0.5))
+        utils.write_metrics(metrics_file, event='eval', step=1000, time=2.0)
+
+        with open(metrics_file) as f:
+            lines = [json.loads(line) for line in f]
+
+        self.assertEqual([line['step'] for line in lines], [1000, 1000])
+        self.assertEqual(lines[0]['event'], 'save')
+        self.assertAlmostEqual(lines[0]['time'], 0.5)
+
+
+class PackedFeaturesTest(unittest.TestCase):
+    def setUp(self):
+        data_dir = tempfile.mkdtemp()
+        paths = []
+        for i, frames in enumerate([3, 4]):
+            paths.append(os.path.join(data_dir, 'utt{}.feats41'.format(i)))
+            with open(paths[-1], 'wb') as f:
+                f.write(struct.pack('iii', 1, 2, frames))
+                f.write(np.full((frames, 2), i, dtype=np.float32).tobytes())
+
+        self.filename = os.path.join(data_dir, 'train.feats41')
+        with open(self.filename, 'w') as f:
+            f.writelines(path + '\n' for path in paths)
+
+        script = os.path.join(os.path.dirname(__file__), '..', 'scripts', 'pack-audio-features.py')
+        subprocess.check_call([sys.executable, script, self.filename])
+
+    def test_up_to_date(self):
+        features = utils.read_packed_features(self.filename)
+        self.assertIsInstance(features, utils.BinaryFeatures)
+        self.assertEqual([len(feats) for feats in features], [3, 4])
+
+    def test_stale(self):
+        packed_filename = utils.packed_features_filename(self.filename)
+        mtime = os.path.getmtime(self.filename) - 10
+        os.utime(packed_filename, (mtime, mtime))
+
+        self.assertIsNone(utils.read_packed_features(self.filename))
+        dataset = utils.read_dataset_list([self.filename], ['feats41'], [None], binary_input=[True])
+        self.assertIsInstance(dataset.columns[0], utils.FeatureFileList)
+        self.assertEqual(dataset.lengths.tolist(), [[3], [4]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -13,11 +13,13 @@ import subprocess
 import tensorflow as tf
 import yaml
 import shutil
+import copy
 
 from pprint import pformat
 from operator import itemgetter
 from translate import utils
 from translate.multitask_model import MultiTaskModel
+from translate.translation_model import load_checkpoint
 
 parser = argparse.ArgumentParser()
 parser.add_argument('config', help='load a configuration file in the YAML format')
@@ -31,6 +33,10 @@ parser.add_argument('--decode', help='translate this corpus (one filename for ea
 parser.add_argument('--align', help='translate and show alignments by the attention mechanism', nargs=2)
 parser.add_argument('--eval', help='compute BLEU score on this corpus (source files and target file)', nargs='+')
 parser.add_argument('--train', help='train an NMT model', action='store_true')
+parser.add_argument('--serve', help='run an HTTP server which translates the sentences it receives',
+                    action='store_true')
+parser.add_argument('--eval-step', type=int, help='evaluate the checkpoint that a training process (with '
+                                                  '`async_eval`) saved at this step, and update its best checkpoints')
 
 # TensorFlow configuration
 parser.add_argument('--gpu-id', type=int, help='index of the GPU where to run the computation')
@@ -46,6 +52,8 @@ parser.add_argument('--len-normalization', type=float)
 parser.add_argument('--output')
 parser.add_argument('--max-steps', type=int)
 parser.add_argument('--remove-unk', action='store_const', const=True)
+parser.add_argument('--decode-batch-size', type=int)
+parser.add_argument('--serve-port', type=int)
 parser.add_argument('--wav-files', nargs='*')
 
 """
@@ -55,7 +63,6 @@ Benchmarks:
 - replicate the experiments of the WMT paper on neural post-editing
 
 TODO:
-- reading files as a stream when decoding (useful for large files)
 - symbolic beam-search
 - possibility to build an encoder with 1 bi-directional layer, and several uni-directional layers
 - pre-load data on GPU for small datasets
@@ -85,11 +92,15 @@ def main(args=None):
         for k, v in default_config.items():
             config.setdefault(k, v)
 
+    # settings of this run (including the command-line parameters), for the asynchronous evaluation
+    resolved_config = copy.deepcopy(dict(config))
+
     # enforce parameter constraints
     assert config.steps_per_eval % config.steps_per_checkpoint == 0, (
         'steps-per-eval should be a multiple of steps-per-checkpoint')
-    assert args.decode is not None or args.eval or args.train or args.align, (
-        'you need to specify at least one action (decode, eval, align, or train)')
+    assert (args.decode is not None or args.eval or args.train or args.align or args.serve or
+            args.eval_step is not None), (
+        'you need to specify at least one action (decode, eval, align, serve, or train)')
 
     if args.purge:
         utils.log('deleting previous model')
@@ -113,11 +124,11 @@ def main(args=None):
         'cell_size', 'layers', 'vocab_size', 'embedding_size', 'attention_filters', 'attention_filter_length',
         'use_lstm', 'time_pooling', 'attention_window_size', 'dynamic', 'binary', 'character_level', 'bidir',
         'load_embeddings', 'pooling_avg', 'swap_memory', 'parallel_iterations', 'input_layers',
-        'residual_connections'
+        'residual_connections', 'tokenize', 'lowercase', 'escape_special_chars', 'subwords'
     ]
     # TODO: independent model dir for each task
     task_parameters = [
-        'data_dir', 'train_prefix', 'dev_prefix', 'vocab_prefix', 'ratio', 'lm_file', 'learning_rate',
+        'data_dir', 'train_prefix', 'dev_prefix', 'vocab_prefix', 'bpe_prefix', 'ratio', 'lm_file', 'learning_rate',
         'learning_rate_decay_factor', 'max_output_len', 'encoders', 'decoder'
     ]
 
@@ -173,7 +184,9 @@ def main(args=None):
         # all parameters except source embeddings and bias variables are initialized with this
         # initializer = tf.random_normal_initializer(stddev=0.1)   # TODO: try this one
         with tf.variable_scope('seq2seq', initializer=initializer):
-            decode_only = args.decode is not None or args.eval or args.align  # exempt from creating gradient ops
+            # exempt from creating gradient ops
+            decode_only = (args.decode is not None or args.eval or args.align or args.serve or
+                           args.eval_step is not None)
             model = MultiTaskModel(name='main', checkpoint_dir=checkpoint_dir, decode_only=decode_only, **config)
 
     utils.log('model parameters ({})'.format(len(tf.all_variables())))
@@ -187,12 +200,17 @@ def main(args=None):
     with tf.Session(config=tf_config) as sess:
         best_checkpoint = os.path.join(checkpoint_dir, 'best')
 
-        if config.ensemble and (args.eval or args.decode is not None):
+        if args.eval_step is not None:
+            # checkpoint linked by a training process (load all the variables, including the global step)
+            model.initialize(sess, reset=True)
+            load_checkpoint(sess, None, os.path.join(checkpoint_dir, 'eval-{}'.format(args.eval_step)))
+        elif config.ensemble and (args.eval or args.decode is not None or args.serve):
             # create one session for each model in the ensemble
-            sess = [tf.Session() for _ in config.checkpoints]
+            sess = [tf.Session(config=tf_config) for _ in config.checkpoints]
             for sess_, checkpoint in zip(sess, config.checkpoints):
                 model.initialize(sess_, [checkpoint], reset=True)
-        elif (not config.checkpoints and not args.reset and (args.eval or args.decode is not None or args.align)
+        elif (not config.checkpoints and not args.reset and
+              (args.eval or args.decode is not None or args.align or args.serve)
               and os.path.isfile(best_checkpoint)):
             # in decoding and evaluation mode, unless specified otherwise (by `checkpoints` or `reset` parameters,
             # try to load the best checkpoint)
@@ -211,12 +229,25 @@ def main(args=None):
             model.evaluate(sess, on_dev=False, **config)
         elif args.align:
             model.align(sess, wav_files=args.wav_files, **config)
+        elif args.serve:
+            model.serve(sess, **config)
+        elif args.eval_step is not None:
+            eval_output = os.path.join(config.model_dir, 'eval')
+            model.evaluate_checkpoint(sess, args.eval_step, eval_output=eval_output, **config)
         elif args.train:
             eval_output = os.path.join(config.model_dir, 'eval')
+            config_file = args.config
+            if config.async_eval:
+                # the evaluation process must use the same settings as this process
+                config_file = os.path.join(config.model_dir, 'eval-config.yaml')
+                os.makedirs(config.model_dir, exist_ok=True)
+                with open(config_file, 'w') as f:
+                    yaml.safe_dump(resolved_config, f)
             try:
-                model.train(sess, eval_output=eval_output, **config)
+                model.train(sess, eval_output=eval_output, config_file=config_file, **config)
             except KeyboardInterrupt:
                 utils.log('exiting...')
+                model.stop_async_eval()
                 model.save(sess)
                 sys.exit()
 
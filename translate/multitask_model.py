@@ -1,12 +1,16 @@
+import os
+import sys
 import time
+import subprocess
 import math
+import glob
 import numpy as np
 from translate import utils
-from translate.translation_model import TranslationModel, BaseTranslationModel
+from translate.translation_model import TranslationModel, BaseTranslationModel, link_checkpoint, remove_checkpoint
 
 
 class MultiTaskModel(BaseTranslationModel):
-    def __init__(self, name, tasks, checkpoint_dir, keep_best=1, main_task=None, **kwargs):
+    def __init__(self, name, tasks, checkpoint_dir, keep_best=1, main_task=None, async_save=False, **kwargs):
         """
         Proxy for several translation models that are trained jointly
         This class presents the same interface as TranslationModel
@@ -21,7 +25,7 @@ class MultiTaskModel(BaseTranslationModel):
             for k, v in kwargs.items():
                 kwargs_.setdefault(k, v)
 
-            model = TranslationModel(checkpoint_dir=None, keep_best=keep_best, **kwargs_)
+            model = TranslationModel(checkpoint_dir=None, keep_best=keep_best, async_save=async_save, **kwargs_)
 
             self.models.append(model)
             self.ratios.append(task.ratio if task.ratio is not None else 1)
@@ -30,20 +34,34 @@ class MultiTaskModel(BaseTranslationModel):
 
         self.main_task = main_task
         self.global_step = 0  # steps of all tasks combined
-        super(MultiTaskModel, self).__init__(name, checkpoint_dir, keep_best)
+        self.eval_queue = []  # steps whose checkpoint is waiting for asynchronous evaluation
+        self.eval_process = None
+        super(MultiTaskModel, self).__init__(name, checkpoint_dir, keep_best, async_save=async_save)
 
     def train(self, sess, beam_size, steps_per_checkpoint, score_function, steps_per_eval=None, max_train_size=None,
               max_dev_size=None, eval_output=None, max_steps=0, auxiliary_score_function=None, script_dir='scripts',
-              **kwargs):
+              decode_batch_size=1, partial_score_every=0, model_dir=None, async_eval=False, config_file=None,
+              async_eval_queue=2, **kwargs):
         utils.log('reading training and development data')
 
+        # machine-readable training metrics (one JSON object per line)
+        metrics_file = None
+        if model_dir is not None:
+            os.makedirs(model_dir, exist_ok=True)
+            metrics_file = os.path.join(model_dir, 'metrics.jsonl')
+
+        if async_eval:
+            assert config_file is not None and model_dir is not None
+            # checkpoints left by an interrupted run
+            for filename in glob.glob(os.path.join(self.checkpoint_dir, 'eval-*')):
+                os.remove(filename)
+
         self.global_step = 0
         for model in self.models:
             model.read_data(max_train_size, max_dev_size)
-            # those parameters are used to track the progress of each task
-            model.loss, model.time, model.steps = 0, 0, 0
+            model.reset_metrics()
             model.previous_losses = []
-            self.global_step += model.global_step.eval(sess)
+            self.global_step += int(model.global_step.eval(sess))
 
         utils.log('starting training')
         while True:
@@ -52,7 +70,7 @@ class MultiTaskModel(BaseTranslationModel):
 
             start_time = time.time()
             model.loss += model.train_step(sess)
-            model.time += (time.time() - start_time)
+            model.time += time.time() - start_time
             model.steps += 1
             self.global_step += 1
 
@@ -63,56 +81,172 @@ class MultiTaskModel(BaseTranslationModel):
 
                     loss_ = model_.loss / model_.steps
                     step_time_ = model_.time / model_.steps
+                    input_time_ = model_.input_time / model_.steps
                     perplexity = math.exp(loss_) if loss_ < 300 else float('inf')
 
-                    utils.log('{} step {} learning rate {:.4f} step-time {:.2f} perplexity {:.2f}'.format(
-                        model_.name, model_.global_step.eval(sess), model_.learning_rate.eval(),
-                        step_time_, perplexity))
+                    metrics = dict(
+                        task=model_.name, step=int(model_.global_step.eval(sess)),
+                        learning_rate=float(model_.learning_rate.eval()), perplexity=perplexity,
+                        step_time=step_time_, input_time=input_time_,
+                        batch_time=model_.batch_time / model_.steps, run_time=model_.run_time / model_.steps,
+                        src_tokens_per_sec=float(model_.src_tokens / model_.time),
+                        trg_tokens_per_sec=float(model_.trg_tokens / model_.time),
+                        padding_ratio=float(1 - (model_.src_tokens + model_.trg_tokens) / model_.padded_tokens)
+                    )
+
+                    utils.log('{task} step {step} learning rate {learning_rate:.4f} step-time {step_time:.2f} '
+                              'input-time {input_time:.2f} perplexity {perplexity:.2f}'.format(**metrics))
+                    utils.log('{task} batch-time {batch_time:.3f} run-time {run_time:.3f} '
+                              'src-tokens/s {src_tokens_per_sec:.0f} trg-tokens/s {trg_tokens_per_sec:.0f} '
+                              'padding {padding_ratio:.2f}'.format(**metrics))
+                    utils.write_metrics(metrics_file, event='train', **metrics)
 
                     if len(model_.previous_losses) > 2 and loss_ > max(model_.previous_losses[-3:]):
                         sess.run(model_.learning_rate_decay_op)
 
                     model_.previous_losses.append(loss_)
-                    model_.loss, model_.time, model_.steps = 0, 0, 0
+                    model_.reset_metrics()
                     model_.eval_step(sess)
 
+                start_time = time.time()
                 self.save(sess)
+                save_time = time.time() - start_time
+                utils.debug('save-time {:.2f}'.format(save_time))
+                utils.write_metrics(metrics_file, event='save', step=self.global_step, time=save_time)
 
             if steps_per_eval and self.global_step % steps_per_eval == 0:
-                score = 0
-
-                for ratio, model_ in zip(self.ratios, self.models):
-                    if eval_output is None:
-                        output = None
-                    elif len(model_.filenames.dev) > 1:
-                        # if there are several dev files, we define several output files
-                        # TODO: put dev_prefix into the name of the output file (also in the logging output)
-                        output = [
-                            '{}.{}.{}.{}'.format(eval_output, i + 1, model_.name, model_.global_step.eval(sess))
-                            for i in range(len(model_.filenames.dev))
-                        ]
-                    else:
-                        output = '{}.{}.{}'.format(eval_output, model_.name, model_.global_step.eval(sess))
-
-                    scores_ = model_.evaluate(
-                        sess, beam_size, on_dev=True, output=output, score_function=score_function,
-                        auxiliary_score_function=auxiliary_score_function, script_dir=script_dir
+                start_time = time.time()
+                if async_eval:
+                    # the checkpoint that was just saved is evaluated by another process
+                    self.wait_for_save()
+                    link_checkpoint(self.checkpoint_dir, 'translate-{}'.format(self.global_step),
+                                    'eval-{}'.format(self.global_step))
+                    self.eval_queue.append(self.global_step)
+                    # if the evaluation is slower than training, only evaluate the latest checkpoints
+                    while len(self.eval_queue) > max(1, async_eval_queue):
+                        step = self.eval_queue.pop(0)
+                        utils.warn('asynchronous evaluation is too slow, skipping step {}'.format(step))
+                        remove_checkpoint(self.checkpoint_dir, 'eval-{}'.format(step))
+                else:
+                    score = self.evaluate_dev(
+                        sess, beam_size, score_function=score_function, eval_output=eval_output,
+                        auxiliary_score_function=auxiliary_score_function, script_dir=script_dir,
+                        decode_batch_size=decode_batch_size, partial_score_every=partial_score_every
                     )
-                    score_ = scores_[0]  # in case there are several dev files, only the first one counts
+                    self.manage_best_checkpoints(self.global_step, score)
 
-                    # if there is a main task, pick best checkpoint according to its score
-                    # otherwise use the average score across tasks
-                    if self.main_task is None:
-                        score += ratio * score_
-                    elif model_.name == self.main_task:
-                        score = score_
+                eval_time = time.time() - start_time
+                utils.log('eval-time {:.2f}'.format(eval_time))
+                utils.write_metrics(metrics_file, event='eval', step=self.global_step, time=eval_time)
 
-                self.manage_best_checkpoints(self.global_step, score)
+            if async_eval:
+                self.poll_async_eval(config_file, model_dir)
 
             if 0 < max_steps < self.global_step:
+                if async_eval:
+                    self.poll_async_eval(config_file, model_dir, wait=True)
                 utils.log('finished training')
                 return
 
+    def evaluate_dev(self, sess, beam_size, score_function, eval_output=None, auxiliary_score_function=None,
+                     script_dir='scripts', decode_batch_size=1, partial_score_every=0, **kwargs):
+        """
+        Evaluate each task on its development corpora.
+
+        :param eval_output: prefix of the files where the hypotheses are saved
+        :return: score used for selecting the best checkpoints: score of the main task if
+          there is one, otherwise weighted average of the scores of all tasks
+        """
+        score = 0
+
+        for ratio, model_ in zip(self.ratios, self.models):
+            if eval_output is None:
+                output = None
+            elif len(model_.filenames.dev) > 1:
+                # if there are several dev files, we define several output files
+                # TODO: put dev_prefix into the name of the output file (also in the logging output)
+                output = [
+                    '{}.{}.{}.{}'.format(eval_output, i + 1, model_.name, model_.global_step.eval(sess))
+                    for i in range(len(model_.filenames.dev))
+                ]
+            else:
+                output = '{}.{}.{}'.format(eval_output, model_.name, model_.global_step.eval(sess))
+
+            scores_ = model_.evaluate(
+                sess, beam_size, on_dev=True, output=output, score_function=score_function,
+                auxiliary_score_function=auxiliary_score_function, script_dir=script_dir,
+                decode_batch_size=decode_batch_size, partial_score_every=partial_score_every
+            )
+            score_ = scores_[0]  # in case there are several dev files, only the first one counts
+
+            # if there is a main task, pick best checkpoint according to its score
+            # otherwise use the average score across tasks
+            if self.main_task is None:
+                score += ratio * score_
+            elif model_.name == self.main_task:
+                score = score_
+
+        return score
+
+    def evaluate_checkpoint(self, sess, step, **kwargs):
+        """
+        Evaluate the checkpoint `eval-STEP` that was linked by an asynchronous training run
+        (the model must already be loaded), update the best checkpoints, and remove this checkpoint.
+        """
+        score = self.evaluate_dev(sess, **kwargs)
+        name = 'eval-{}'.format(step)
+        self.manage_best_checkpoints(step, score, checkpoint=name)
+        remove_checkpoint(self.checkpoint_dir, name)
+
+    def poll_async_eval(self, config_file, model_dir, wait=False):
+        """
+        Start the evaluation of the next checkpoint in the queue, if no evaluation is currently running.
+        Evaluations are done one at a time (in order), by a CPU-only process (see `evaluate_checkpoint`).
+
+        :param wait: wait until all the checkpoints in the queue are evaluated
+        """
+        while True:
+            if self.eval_process is not None:
+                if wait:
+                    self.eval_process.wait()
+                if self.eval_process.poll() is None:
+                    return
+                if self.eval_process.returncode != 0:
+                    utils.warn('asynchronous evaluation failed (see {})'.format(self.eval_process.log_file))
+                self.eval_process = None
+
+            if not self.eval_queue:
+                return
+
+            step = self.eval_queue.pop(0)
+            log_file = os.path.join(model_dir, 'eval.log')
+            utils.log('starting asynchronous evaluation of step {} (logs in {})'.format(step, log_file))
+
+            env = dict(os.environ, CUDA_VISIBLE_DEVICES='')
+            args = [sys.executable, '-m', 'translate', config_file, '--eval-step', str(step), '--no-gpu']
+            with open(log_file, 'a') as f:
+                self.eval_process = subprocess.Popen(args, stdout=f, stderr=subprocess.STDOUT, env=env)
+            self.eval_process.log_file = log_file
+            self.eval_process.step = step
+
+    def stop_async_eval(self):
+        """
+        Stop the current asynchronous evaluation (when training is interrupted), and remove
+        the checkpoints that are waiting for evaluation.
+        """
+        steps = self.eval_queue
+        if self.eval_process is not None:
+            if self.eval_process.poll() is None:
+                self.eval_process.terminate()
+                self.eval_process.wait()
+            steps = [self.eval_process.step] + steps
+
+        for step in steps:
+            remove_checkpoint(self.checkpoint_dir, 'eval-{}'.format(step))
+
+        self.eval_queue = []
+        self.eval_process = None
+
     def decode(self, *args, **kwargs):
         if self.main_task is not None:
             model = next(model for model in self.models if model.name == self.main_task)
@@ -120,6 +254,13 @@ class MultiTaskModel(BaseTranslationModel):
             model = self.models[0]
         return model.decode(*args, **kwargs)
 
+    def serve(self, *args, **kwargs):
+        if self.main_task is not None:
+            model = next(model for model in self.models if model.name == self.main_task)
+        else:
+            model = self.models[0]
+        return model.serve(*args, **kwargs)
+
     def evaluate(self, *args, **kwargs):
         if self.main_task is not None:
             model = next(model for model in self.models if model.name == self.main_task)
@@ -0,0 +1,243 @@
+"""
+In-process versions of the pre-processing steps of `scripts/prepare-data.py` (tokenizer.perl,
+lowercase.perl, escape-special-chars.perl and apply_bpe.py), and of their inverse operations.
+
+This is used to translate raw text with `--decode` and `--serve`, without spawning a chain
+of Perl and Python processes for each request.
+"""
+import os
+import re
+import html
+import importlib.util
+
+from translate import utils
+
+# character classes of `tokenizer.perl` (Perl's \p{IsAlnum}, \p{IsAlpha} and \p{IsN})
+_alnum = r'[^\W_]'
+_not_alnum = r'[\W_]'
+_alpha = r'[^\W\d_]'
+_not_alpha = r'[\W\d_]'
+
+
+def read_nonbreaking_prefixes(lang, prefix_dir):
+    """
+    Read the list of prefixes which, followed by a period, do not end a sentence.
+
+    :param lang: language of the prefixes (falls back to English if no list exists for this language)
+    :param prefix_dir: directory containing the `nonbreaking_prefix.LANG` files
+    :return: dict mapping prefixes to 1, or to 2 for prefixes which only apply before numbers
+    """
+    filename = os.path.join(prefix_dir, 'nonbreaking_prefix.{}'.format(lang))
+    if not os.path.exists(filename):
+        utils.warn('no known abbreviations for language "{}", falling back to English'.format(lang))
+        filename = os.path.join(prefix_dir, 'nonbreaking_prefix.en')
+
+    prefixes = {}
+    with open(filename, encoding='utf-8') as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if not line or line.startswith('#'):
+                continue
+            m = re.match(r'(.*)\s+#NUMERIC_ONLY#', line)
+            if m:
+                prefixes[m.group(1)] = 2
+            else:
+                prefixes[line] = 1
+    return prefixes
+
+
+class Tokenizer(object):
+    """
+    Python port of `scripts/tokenizer.perl`
+    """
+    def __init__(self, lang='en', prefix_dir='scripts/nonbreaking_prefixes'):
+        self.lang = lang
+        self.prefixes = read_nonbreaking_prefixes(lang, prefix_dir)
+
+    def tokenize(self, text):
+        text = text.rstrip('\n')
+        if re.match(r'^<.+>$', text) or not text.strip():  # don't tokenize XML/HTML tag lines
+            return text
+
+        text = ' {} '.format(text)
+
+        # separate out all "other" special characters
+        text = re.sub(r"([^\w\s.'`,\-]|_)", r' \1 ', text)
+
+        # multi-dots stay together
+        text = re.sub(r'\.(\.+)', r' DOTMULTI\1', text)
+        while 'DOTMULTI.' in text:
+            text = re.sub(r'DOTMULTI\.([^.])', r'DOTDOTMULTI \1', text)
+            text = text.replace('DOTMULTI.', 'DOTDOTMULTI')
+
+        # separate out "," except if within numbers (5,300)
+        text = re.sub(r'(\D),(\D)', r'\1 , \2', text)
+        text = re.sub(r'(\d),(\D)', r'\1 , \2', text)
+        text = re.sub(r'(\D),(\d)', r'\1 , \2', text)
+
+        text = text.replace('`', "'")
+        text = text.replace("''", ' " ')
+
+        if self.lang == 'en':
+            text = re.sub(r"({0})'({0})".format(_not_alpha), r"\1 ' \2", text)
+            text = re.sub(r"({})'({})".format(_not_alnum, _alpha), r"\1 ' \2", text)
+            text = re.sub(r"({})'({})".format(_alpha, _not_alpha), r"\1 ' \2", text)
+            text = re.sub(r"({0})'({0})".format(_alpha), r"\1 '\2", text)
+            text = re.sub(r"(\d)'(s)", r"\1 '\2", text)
+        elif self.lang in ('fr', 'it'):
+            text = re.sub(r"({0})'({0})".format(_not_alpha), r"\1 ' \2", text)
+            text = re.sub(r"({})'({})".format(_not_alpha, _alpha), r"\1 ' \2", text)
+            text = re.sub(r"({})'({})".format(_alpha, _not_alpha), r"\1 ' \2", text)
+            text = re.sub(r"({0})'({0})".format(_alpha), r"\1' \2", text)
+        else:
+            text = text.replace("'", " ' ")
+
+        words = re.split(r'\s', text)
+        while words and not words[-1]:
+            words.pop()
+
+        for i, word in enumerate(words):
+            m = re.match(r'^(\S+)\.$', word)
+            if not m:
+                continue
+            prefix = m.group(1)
+            next_word = words[i + 1] if i < len(words) - 1 else ''
+
+            if (('.' in prefix and re.search(_alpha, prefix)) or self.prefixes.get(prefix) == 1 or
+                    next_word[:1].islower()):
+                pass
+            elif self.prefixes.get(prefix) == 2 and re.match(r'^[0-9]', next_word):
+                pass
+            else:
+                words[i] = prefix + ' .'
+
+        text = ' '.join(words)
+        text = re.sub(r' +', ' ', text).strip(' ')
+        while 'DOTDOTMULTI' in text:
+            text = text.replace('DOTDOTMULTI', 'DOTMULTI.')
+        return text.replace('DOTMULTI', '.')
+
+
+def detokenize(text, lang='en'):
+    """
+    Undo the tokenization of `Tokenizer` (this is a simplified version of Moses' detokenizer)
+    """
+    tokens = text.split()
+    output = []
+    glue_next = True  # no space before the first token
+    open_quotes = {'"': False, "'": False}
+
+    for i, token in enumerate(tokens):
+        next_token = tokens[i + 1] if i < len(tokens) - 1 else ''
+
+        if re.match(r'^[\[({¿¡$£€]+$', token):
+            # opening brackets and currency symbols are attached to the next token
+            output.append(token if glue_next else ' ' + token)
+            glue_next = True
+        elif re.match(r'^[,.?!:;%})\]]+$', token):
+            # French puts a space before some punctuation marks
+            space = lang == 'fr' and re.match(r'^[?!:;]+$', token) and not glue_next
+            output.append(' ' + token if space else token)
+            glue_next = False
+        elif lang == 'en' and i > 0 and re.match(r"^'{}".format(_alpha), token) and \
+                re.search(_alnum + '$', tokens[i - 1]):
+            output.append(token)  # e.g., "it 's" -> "it's"
+            glue_next = False
+        elif lang == 'en' and token == "n't":
+            output.append(token)
+            glue_next = False
+        elif lang in ('fr', 'it') and re.search(_alpha + "'$", token) and re.match(_alpha, next_token):
+            output.append(token if glue_next else ' ' + token)  # e.g., "l' homme" -> "l'homme"
+            glue_next = True
+        elif token in open_quotes:
+            if open_quotes[token]:  # closing quote: attached to the previous token
+                output.append(token)
+                glue_next = False
+            else:  # opening quote: attached to the next token
+                output.append(token if glue_next else ' ' + token)
+                glue_next = True
+            open_quotes[token] = not open_quotes[token]
+        else:
+            output.append(token if glue_next else ' ' + token)
+            glue_next = False
+
+    return ''.join(output)
+
+
+def escape_special_chars(text):
+    """
+    Python port of `scripts/escape-special-chars.perl`
+    """
+    text = re.sub(r'[\000-\037]', '', text)
+    text = re.sub(r'\s+', ' ', text).strip(' ')
+
+    for char, escaped in [('&', '&amp;'), ('|', '&#124;'), ('<', '&lt;'), ('>', '&gt;'), ("'", '&apos;'),
+                          ('"', '&quot;'), ('[', '&#91;'), (']', '&#93;')]:
+        text = text.replace(char, escaped)
+
+    return re.sub(r'&lt;(\S+) translation=&quot;(.+?)&quot;&gt; (.+?) &lt;/(\S+)&gt;',
+                  r'<\1 translation="\2"> \3 </\4>', text)
+
+
+def unescape_special_chars(text):
+    """
+    Python port of `scripts/unescape-special-chars.perl`
+    """
+    text = re.sub(r'[\000-\037]', '', text)
+    text = re.sub(r'\s+', ' ', text).strip(' ')
+    return html.unescape(text)
+
+
+def load_bpe(codes_path, script_dir='scripts'):
+    """
+    Load BPE codes, using the `BPE` class of `scripts/apply_bpe.py` (which caches the segmentations)
+    """
+    spec = importlib.util.spec_from_file_location('apply_bpe', os.path.join(script_dir, 'apply_bpe.py'))
+    apply_bpe = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(apply_bpe)
+
+    with open(codes_path, encoding='utf-8') as codes:
+        return apply_bpe.BPE(codes)
+
+
+class Preprocessor(object):
+    """
+    Convert raw text to the format of the training data (in the same order as `scripts/prepare-data.py`),
+    and convert the output of the model back to raw text.
+
+    :param lang: language of the text (used by the tokenizer)
+    :param tokenize: tokenize the inputs, and detokenize the outputs
+    :param lowercase: lowercase the inputs
+    :param escape_special_chars: escape special characters in the inputs, and unescape them in the outputs
+    :param bpe_codes: path to BPE codes, used to segment the inputs into subword units
+    :param script_dir: directory containing `apply_bpe.py` and the non-breaking prefixes
+    """
+    def __init__(self, lang, tokenize=False, lowercase=False, escape_special_chars=False, bpe_codes=None,
+                 script_dir='scripts'):
+        self.lang = lang
+        self.lowercase = lowercase
+        self.escape_special_chars = escape_special_chars
+        prefix_dir = os.path.join(script_dir, 'nonbreaking_prefixes')
+        self.tokenizer = Tokenizer(lang, prefix_dir) if tokenize else None
+        self.bpe = load_bpe(bpe_codes, script_dir) if bpe_codes else None
+
+    def preprocess(self, sentence):
+        if self.bpe is not None:
+            sentence = re.sub('@+', '@', sentence)  # @@ is used as delimiter for subwords
+        if self.tokenizer is not None:
+            sentence = self.tokenizer.tokenize(sentence)
+        if self.lowercase:
+            sentence = sentence.lower()
+        if self.escape_special_chars:
+            sentence = escape_special_chars(sentence)
+        if self.bpe is not None:
+            sentence = self.bpe.segment(sentence).strip()
+        return sentence
+
+    def postprocess(self, sentence):
+        # subword units are already merged by the decoder
+        if self.escape_special_chars:
+            sentence = unescape_special_chars(sentence)
+        if self.tokenizer is not None:
+            sentence = detokenize(sentence, self.lang)
+        return sentence
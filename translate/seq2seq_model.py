@@ -22,6 +22,7 @@ import re
 from translate import utils
 from translate import decoders
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 from tensorflow.python.ops import variable_scope
 
@@ -60,6 +61,7 @@ class Seq2SeqModel(object):
         self.max_output_len = max_output_len
         self.max_input_len = max_input_len
         self.len_normalization = len_normalization
+        self.executor = None  # thread pool for ensemble decoding
 
 
         # if we use sampled softmax, we need an output projection
@@ -184,13 +186,17 @@ class Seq2SeqModel(object):
 
         self.beam_output = tf.nn.softmax(self.beam_output)
 
-    def step(self, session, data, forward_only=False, align=False):
-        if self.dropout is not None:
-            session.run(self.dropout_on)
+    def get_input_feed(self, data):
+        """
+        Pad a batch of data points with `get_batch`, and map the resulting arrays to the
+        corresponding placeholders. This doesn't use the session, and can thus be done ahead
+        of time by background threads (see `utils.prefetch_iterator`).
 
+        :param data: list of data points (one input for each encoder and decoder)
+        :return: feed dictionary for the `step` method
+        """
         batch = self.get_batch(data)
         encoder_inputs, decoder_inputs, targets, target_weights, encoder_input_length, decoder_input_length = batch
-        tf.get_variable_scope().reuse_variables()
 
         input_feed = {}
         for i in range(self.encoder_count):
@@ -201,6 +207,15 @@ class Seq2SeqModel(object):
         input_feed[self.decoder_inputs] = decoder_inputs
         input_feed[self.decoder_input_length] = decoder_input_length
         input_feed[self.targets] = targets
+        return input_feed
+
+    def step(self, session, data=None, forward_only=False, align=False, input_feed=None):
+        if self.dropout is not None:
+            session.run(self.dropout_on)
+
+        if input_feed is None:
+            input_feed = self.get_input_feed(data)
+        tf.get_variable_scope().reuse_variables()
 
         output_feed = {'loss': self.loss}
         if not forward_only:
@@ -212,10 +227,26 @@ class Seq2SeqModel(object):
         return namedtuple('output', 'loss attn_weights')(res['loss'], res.get('attn_weights'))
 
     def greedy_decoding(self, session, token_ids):
+        """
+        Greedy decoding of a single sentence (see `batch_greedy_decoding`)
+
+        :return: pair (output token ids, attention weights)
+        """
+        trg_token_ids, attn_weights = self.batch_greedy_decoding(session, [token_ids])
+        return trg_token_ids[0], attn_weights
+
+    def batch_greedy_decoding(self, session, token_ids):
+        """
+        Greedy decoding of several sentences with a single `session.run` call.
+
+        :param session: TensorFlow session
+        :param token_ids: list of sentences, each sentence is a list of inputs (one for each encoder)
+        :return: pair (list of output token ids for each sentence, attention weights)
+        """
         if self.dropout is not None:
             session.run(self.dropout_off)
 
-        batch = self.get_batch([token_ids + [[]]], decoding=True)
+        batch = self.get_batch([token_ids_ + [[]] for token_ids_ in token_ids], decoding=True)
         encoder_inputs, decoder_inputs, targets, target_weights, encoder_input_length, decoder_input_length = batch
 
         input_feed = {}
@@ -230,9 +261,50 @@ class Seq2SeqModel(object):
         input_feed[self.feed_previous] = 1.0
 
         outputs, attn_weights = session.run([self.outputs, self.attention_weights], input_feed)
-        return [int(np.argmax(logit, axis=1)) for logit in outputs], attn_weights  # greedy decoder
+        # outputs has shape (time_steps, batch_size, trg_vocab_size)
+        return np.argmax(outputs, axis=2).T.tolist(), attn_weights  # greedy decoder
+
+    def run_sessions(self, sessions, output_feed, input_feeds):
+        """
+        Run the same fetches in several sessions (ensemble decoding). The sessions
+        are run concurrently in a thread pool (`session.run` releases the GIL).
+
+        :param sessions: list of TensorFlow sessions
+        :param output_feed: fetches passed to each `session.run` call
+        :param input_feeds: list of feed dicts (one for each session)
+        :return: list of results (one for each session)
+        """
+        if len(sessions) == 1:
+            return [sessions[0].run(output_feed, input_feeds[0])]
+
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=len(sessions))
+
+        futures = [self.executor.submit(session.run, output_feed, input_feed)
+                   for session, input_feed in zip(sessions, input_feeds)]
+        return [future.result() for future in futures]
 
     def beam_search_decoding(self, session, token_ids, beam_size, ngrams=None):
+        """
+        Beam-search decoding of a single sentence (see `batch_beam_search_decoding`)
+
+        :return: pair (hypotheses, scores), sorted by score (best hypothesis first)
+        """
+        return self.batch_beam_search_decoding(session, [token_ids], beam_size, ngrams=ngrams)[0]
+
+    def batch_beam_search_decoding(self, session, token_ids, beam_size, ngrams=None):
+        """
+        Beam-search decoding of several sentences at once. The hypotheses of all the sentences
+        are packed into the same batch, so that each step of the decoder is a single `session.run`
+        call (for each model in the ensemble).
+
+        :param session: TensorFlow session, or list of sessions (ensemble decoding)
+        :param token_ids: list of sentences, each sentence is a list of inputs (one for each encoder)
+        :param beam_size: maximum number of hypotheses for each sentence
+        :param ngrams: optional language model (`utils.NGramLanguageModel`)
+        :return: list of pairs (hypotheses, scores), one for each sentence, sorted by score
+          (best hypothesis first)
+        """
         if not isinstance(session, list):
             session = [session]
 
@@ -240,7 +312,7 @@ class Seq2SeqModel(object):
             for session_ in session:
                 session_.run(self.dropout_off)
 
-        data = [token_ids + [[]]]
+        data = [token_ids_ + [[]] for token_ids_ in token_ids]
         batch = self.get_batch(data, decoding=True)
         encoder_inputs, decoder_inputs, targets, target_weights, encoder_input_length, _ = batch
         input_feed = {}
@@ -249,23 +321,27 @@ class Seq2SeqModel(object):
             input_feed[self.encoder_inputs[i]] = encoder_inputs[i]
 
         output_feed = [self.encoder_state] + self.attention_states
-        res = [session_.run(output_feed, input_feed) for session_ in session]
+        res = self.run_sessions(session, output_feed, [input_feed] * len(session))
         state, attn_states = list(zip(*[(res_[0], res_[1:]) for res_ in res]))
 
         attns = [None for _ in session]
         attn_weights = [None for _ in session]
 
-        decoder_input = decoder_inputs[0]  # BOS symbol
+        sentence_count = len(data)
+        decoder_input = decoder_inputs[0]  # BOS symbol (one for each sentence)
 
-        finished_hypotheses = []
-        finished_scores = []
+        finished_hypotheses = [[] for _ in range(sentence_count)]
+        finished_scores = [[] for _ in range(sentence_count)]
+        beam_sizes = [beam_size] * sentence_count
 
-        hypotheses = [[]]
-        scores = np.zeros([1], dtype=np.float32)
+        # each row of the batch is a hypothesis, `sentence_ids` gives the sentence it belongs to
+        hypotheses = [[] for _ in range(sentence_count)]
+        scores = np.zeros([sentence_count], dtype=np.float32)
+        sentence_ids = np.arange(sentence_count)
 
         # for initial state projection
-        state = [session_.run(self.beam_tensors.state, {self.encoder_state: state_})
-                 for session_, state_ in zip(session, state)]
+        state = self.run_sessions(session, self.beam_tensors.state,
+                                  [{self.encoder_state: state_} for state_ in state])
 
         for _ in range(self.max_output_len):
             # each session/model has its own input and output
@@ -275,11 +351,9 @@ class Seq2SeqModel(object):
                 for state_ in state
             ]
 
-            batch_size = decoder_input.shape[0]
-
             for input_feed_, attn_states_, attns_, attn_weights_ in zip(input_feed, attn_states, attns, attn_weights):
                 for i in range(self.encoder_count):
-                    input_feed_[self.attention_states[i]] = attn_states_[i].repeat(batch_size, axis=0)
+                    input_feed_[self.attention_states[i]] = attn_states_[i][sentence_ids]
                     if attn_weights_ is not None:
                         input_feed_[self.beam_tensors.attn_weights[i]] = attn_weights_[i]
 
@@ -293,113 +367,94 @@ class Seq2SeqModel(object):
                 self.beam_tensors.new_attn_weights
             )
 
-            res = [session_.run(output_feed, input_feed_) for session_, input_feed_ in zip(session, input_feed)]
+            res = self.run_sessions(session, output_feed, input_feed)
 
             res_transpose = list(
                 zip(*[(res_.decoder_output, res_.decoder_state, res_.attns, res_.attn_weights) for res_ in res])
             )
 
             decoder_output, decoder_state, attns, attn_weights = res_transpose
-            # hypotheses, list of tokens ids of shape (beam_size, previous_len)
-            # decoder_output, shape=(beam_size, trg_vocab_size)
-            # decoder_state, shape=(beam_size, cell.state_size)
-            # attention_weights, shape=(beam_size, max_len)
+            # hypotheses, list of tokens ids of shape (hypotheses, previous_len)
+            # decoder_output, shape=(hypotheses, trg_vocab_size)
+            # decoder_state, shape=(hypotheses, cell.state_size)
+            # attention_weights, shape=(hypotheses, max_len)
 
             if ngrams is not None:
-                lm_score = []
-                lm_order = len(ngrams)
-
-                for hypothesis in hypotheses:
-                    # not sure about this (should we put <s> at the beginning?)
-                    hypothesis = [utils.BOS_ID] + hypothesis
-                    history = hypothesis[1 - lm_order:]
-                    score_ = []
-
-                    for token_id in range(self.trg_vocab_size):
-                        # if token is not in unigrams, this means that either there is something
-                        # wrong with the ngrams (e.g. trained on wrong file),
-                        # or trg_vocab_size is larger than actual vocabulary
-                        if (token_id,) not in ngrams[0]:
-                            prob = float('-inf')
-                        elif token_id == utils.BOS_ID:
-                            prob = float('-inf')
-                        else:
-                            prob = utils.estimate_lm_score(history + [token_id], ngrams)
-                        score_.append(prob)
-
-                    lm_score.append(score_)
-                lm_score = np.array(lm_score, dtype=np.float32)
+                # if a token is not in unigrams, this means that either there is something
+                # wrong with the ngrams (e.g. trained on wrong file),
+                # or trg_vocab_size is larger than actual vocabulary (those tokens get a score of -inf)
+                lm_score = ngrams.scores(hypotheses, self.trg_vocab_size)
                 lm_weight = self.lm_weight or 0.2
                 weights = [(1 - lm_weight) / len(session)] * len(session) + [lm_weight]
             else:
-                lm_score = np.zeros((1, self.trg_vocab_size))
+                lm_score = np.zeros((len(hypotheses), self.trg_vocab_size))
                 weights = None
 
             # FIXME: divide by zero encountered in log
             scores_ = scores[:, None] - np.average([np.log(decoder_output_) for decoder_output_ in decoder_output] +
                                                    [lm_score], axis=0, weights=weights)
-            scores_ = scores_.flatten()
-            flat_ids = np.argsort(scores_)[:beam_size]
-
-            token_ids_ = flat_ids % self.trg_vocab_size
-            hyp_ids = flat_ids // self.trg_vocab_size
 
             new_hypotheses = []
             new_scores = []
-            new_state = [[] for _ in session]
             new_input = []
-            new_attns = [[] for _ in session]
-            new_attn_weights = [[[] for _ in self.encoders] for _ in session]
-
-            for flat_id, hyp_id, token_id in zip(flat_ids, hyp_ids, token_ids_):
-                hypothesis = hypotheses[hyp_id] + [token_id]
-                score = scores_[flat_id]
-
-                if token_id == utils.EOS_ID:
-                    # early stop: hypothesis is finished, it is thus unnecessary to keep expanding it
-                    beam_size -= 1  # number of possible hypotheses is reduced by one
-                    finished_hypotheses.append(hypothesis)
-                    finished_scores.append(score)
-                else:
-                    new_hypotheses.append(hypothesis)
-
-                    for session_id, decoder_state_ in enumerate(decoder_state):
-                        new_state[session_id].append(decoder_state_[hyp_id])
-
-                    new_scores.append(score)
-                    new_input.append(token_id)
-
-                    for session_id, attn_weights_ in enumerate(attn_weights):
-                        for encoder_id in range(len(self.encoders)):
-                            new_attn_weights[session_id][encoder_id].append(
-                                attn_weights_[encoder_id][hyp_id]
-                            )
-
-                    for session_id, attns_ in enumerate(attns):
-                        new_attns[session_id].append(attns_[hyp_id])
+            new_sentence_ids = []
+            hyp_ids = []  # rows of the batch that are expanded
+
+            for sentence_id in range(sentence_count):
+                rows = np.flatnonzero(sentence_ids == sentence_id)
+                if len(rows) == 0:  # all hypotheses of this sentence are finished
+                    continue
+
+                sentence_scores = scores_[rows].flatten()
+                flat_ids = np.argsort(sentence_scores)[:beam_sizes[sentence_id]]
+
+                for flat_id in flat_ids:
+                    hyp_id = rows[flat_id // self.trg_vocab_size]
+                    token_id = int(flat_id % self.trg_vocab_size)
+                    hypothesis = hypotheses[hyp_id] + [token_id]
+                    score = sentence_scores[flat_id]
+
+                    if token_id == utils.EOS_ID:
+                        # early stop: hypothesis is finished, it is thus unnecessary to keep expanding it
+                        beam_sizes[sentence_id] -= 1  # number of possible hypotheses is reduced by one
+                        finished_hypotheses[sentence_id].append(hypothesis)
+                        finished_scores[sentence_id].append(score)
+                    else:
+                        new_hypotheses.append(hypothesis)
+                        new_scores.append(score)
+                        new_input.append(token_id)
+                        new_sentence_ids.append(sentence_id)
+                        hyp_ids.append(hyp_id)
 
             hypotheses = new_hypotheses
-            state = [np.array(new_state_) for new_state_ in new_state]
-            attn_weights = [[np.array(attn_weights_) for attn_weights_ in session_attn_weights]
-                            for session_attn_weights in new_attn_weights]
-            attns = [np.array(attns_) for attns_ in new_attns]
-            scores = np.array(new_scores)
+            hyp_ids = np.array(hyp_ids, dtype=np.int64)
+            state = [decoder_state_[hyp_ids] for decoder_state_ in decoder_state]
+            attn_weights = [[attn_weights_[hyp_ids] for attn_weights_ in session_attn_weights]
+                            for session_attn_weights in attn_weights]
+            attns = [attns_[hyp_ids] for attns_ in attns]
+            scores = np.array(new_scores, dtype=np.float32)
             decoder_input = np.array(new_input, dtype=np.int32)
+            sentence_ids = np.array(new_sentence_ids, dtype=np.int64)
 
-            if beam_size <= 0:
+            if not hypotheses:
                 break
 
-        hypotheses += finished_hypotheses
-        scores = np.concatenate([scores, finished_scores])
+        results = []
+        for sentence_id in range(sentence_count):
+            rows = np.flatnonzero(sentence_ids == sentence_id)
+            hypotheses_ = [hypotheses[row] for row in rows] + finished_hypotheses[sentence_id]
+            scores__ = np.concatenate([scores[rows], finished_scores[sentence_id]])
+
+            if self.len_normalization > 0:  # normalize score by length (to encourage longer sentences)
+                scores__ /= [len(hypothesis) ** self.len_normalization for hypothesis in hypotheses_]
 
-        if self.len_normalization > 0:  # normalize score by length (to encourage longer sentences)
-            scores /= [len(hypothesis) ** self.len_normalization for hypothesis in hypotheses]
+            # sort best-list by score
+            sorted_idx = np.argsort(scores__)
+            hypotheses_ = [hypotheses_[i] for i in sorted_idx]
+            scores__ = scores__[sorted_idx].tolist()
+            results.append((hypotheses_, scores__))
 
-        # sort best-list by score
-        sorted_idx = np.argsort(scores)
-        hypotheses = np.array(hypotheses)[sorted_idx].tolist()
-        scores = scores[sorted_idx].tolist()
-        return hypotheses, scores
+        return results
 
     def get_batch(self, data, decoding=False):
         """
@@ -408,10 +463,7 @@ class Seq2SeqModel(object):
           data for the decoder side (using the maximum output size)
         :return:
         """
-        encoder_inputs = [[] for _ in range(self.encoder_count)]
-        encoder_input_length = [[] for _ in range(self.encoder_count)]
-        decoder_inputs = []
-        decoder_input_length = []
+        batch_size = len(data)
 
         # maximum input length of each encoder in this batch
         max_input_len = [max(len(data_[i]) for data_ in data) for i in range(self.encoder_count)]
@@ -422,46 +474,46 @@ class Seq2SeqModel(object):
         # maximum output length in this batch
         max_output_len = min(max(len(data_[-1]) for data_ in data), self.max_output_len)
 
-        for *src_sentences, trg_sentence in data:
-            for i, (encoder, src_sentence) in enumerate(zip(self.encoders, src_sentences)):
-                if encoder.binary:
-                    # when using binary input, the input sequence is a sequence of vectors,
-                    # instead of a sequence of indices
-                    pad = np.zeros([encoder.embedding_size], dtype=np.float32)
-                else:
-                    pad = utils.PAD_ID
-
-                # pad sequences so that all sequences in the same batch have the same length
-                src_sentence = src_sentence[:max_input_len[i]]
-                encoder_pad = [pad] * (max_input_len[i] - len(src_sentence))
+        # arrays are allocated with their padding, and filled with the (truncated) sequences
+        batch_encoder_inputs = []
+        encoder_input_length = []
+        for i, (encoder, ext) in enumerate(zip(self.encoders, self.encoder_names)):
+            if ext in self.binary_input:
+                # when using binary input, the input sequence is a sequence of vectors,
+                # instead of a sequence of indices
+                encoder_inputs = np.zeros([batch_size, max_input_len[i], encoder.embedding_size], dtype=np.float32)
+            else:
+                encoder_inputs = np.full([batch_size, max_input_len[i]], utils.PAD_ID, dtype=np.int32)
+            input_length = np.zeros([batch_size], dtype=np.int32)
+
+            for j, data_ in enumerate(data):
+                src_sentence = data_[i][:max_input_len[i]]
                 # reversing the input used to give better results (not sure this is still the case with attention)
-                reversed_sentence = list(reversed(src_sentence)) + encoder_pad
+                encoder_inputs[j, :len(src_sentence)] = src_sentence[::-1]
+                input_length[j] = len(src_sentence)
 
-                encoder_inputs[i].append(reversed_sentence)
-                encoder_input_length[i].append(len(src_sentence))
+            batch_encoder_inputs.append(encoder_inputs)
+            encoder_input_length.append(input_length)
 
-            trg_sentence = trg_sentence[:max_output_len]
-            if decoding:
-                # maximum output length doesn't account for the final EOS symbol
-                decoder_input_length.append(self.max_output_len + 1)
-                decoder_inputs.append([utils.BOS_ID] + [utils.PAD_ID] * (self.max_output_len + 1))
-            else:
-                decoder_pad_size = max_output_len - len(trg_sentence)
-                decoder_input_length.append(len(trg_sentence) + 1)
-                trg_sentence = [utils.BOS_ID] + trg_sentence + [utils.EOS_ID] + [utils.PAD_ID] * decoder_pad_size
-                decoder_inputs.append(trg_sentence)
-
-        # convert lists to numpy arrays
-        encoder_input_length = [np.array(input_length_, dtype=np.int32) for input_length_ in encoder_input_length]
-        decoder_input_length = np.array(decoder_input_length, dtype=np.int32)
-        batch_encoder_inputs = [
-            np.array(encoder_inputs_, dtype=(np.float32 if ext in self.binary_input else np.int32))
-            for ext, encoder_inputs_ in zip(self.encoder_names, encoder_inputs)
-        ]  # for binary input, the data type is float32
+        if decoding:
+            # maximum output length doesn't account for the final EOS symbol
+            decoder_input_length = np.full([batch_size], self.max_output_len + 1, dtype=np.int32)
+            decoder_inputs = np.full([batch_size, self.max_output_len + 2], utils.PAD_ID, dtype=np.int32)
+            decoder_inputs[:, 0] = utils.BOS_ID
+        else:
+            decoder_input_length = np.zeros([batch_size], dtype=np.int32)
+            decoder_inputs = np.full([batch_size, max_output_len + 2], utils.PAD_ID, dtype=np.int32)
+            decoder_inputs[:, 0] = utils.BOS_ID
+
+            for j, data_ in enumerate(data):
+                trg_sentence = data_[-1][:max_output_len]
+                decoder_inputs[j, 1:len(trg_sentence) + 1] = trg_sentence
+                decoder_inputs[j, len(trg_sentence) + 1] = utils.EOS_ID
+                decoder_input_length[j] = len(trg_sentence) + 1
 
         # time-major vectors: shape is (time, batch_size)
-        batch_decoder_inputs = np.array(decoder_inputs)[:, :-1].T  # with BOS symbol, without EOS symbol
-        batch_targets = np.array(decoder_inputs)[:, 1:].T  # without BOS symbol, with EOS symbol
+        batch_decoder_inputs = decoder_inputs[:, :-1].T  # with BOS symbol, without EOS symbol
+        batch_targets = decoder_inputs[:, 1:].T  # without BOS symbol, with EOS symbol
         batch_weights = (batch_targets != utils.PAD_ID).astype(np.float32)  # PAD symbols don't count for training
 
         return (batch_encoder_inputs,
@@ -0,0 +1,132 @@
+"""
+HTTP server which keeps a model in memory and decodes the sentences it receives.
+
+Clients send POST requests whose body is a JSON object:
+  {"sentences": ["first source sentence", "second source sentence"]}
+or, with several encoders, one list of inputs per sentence:
+  {"sentences": [["first input", "second input"]]}
+and receive the translations in the same order:
+  {"translations": ["first translation", "second translation"]}
+
+Each request is handled by its own thread, while the sentences of all pending requests are
+decoded by the main thread (which owns the TensorFlow session), in batches of up to `batch_size`
+sentences. A batch is decoded as soon as it is full, or when its first sentence has waited
+for `max_wait` seconds.
+"""
+import json
+import queue
+import threading
+import time
+
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from translate import utils
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class PendingSentence(object):
+    def __init__(self, inputs):
+        self.inputs = inputs
+        self.output = None
+        self.error = None
+        self.done = threading.Event()
+
+
+def make_handler(pending):
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                sentences = json.loads(self.rfile.read(length).decode())['sentences']
+                if not isinstance(sentences, list):
+                    raise TypeError
+                sentences = [[sentence] if isinstance(sentence, str) else sentence for sentence in sentences]
+            except (ValueError, KeyError, TypeError):
+                self.reply(400, {'error': 'expected a JSON object with a list of "sentences"'})
+                return
+
+            sentences = [PendingSentence(inputs) for inputs in sentences]
+            for sentence in sentences:
+                pending.put(sentence)
+            for sentence in sentences:
+                sentence.done.wait()
+
+            errors = [sentence.error for sentence in sentences if sentence.error is not None]
+            if errors:
+                self.reply(500, {'error': errors[0]})
+            else:
+                self.reply(200, {'translations': [sentence.output for sentence in sentences]})
+
+        def reply(self, code, content):
+            content = json.dumps(content).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, format, *args):
+            utils.debug('{} {}'.format(self.address_string(), format % args))
+
+    return Handler
+
+
+def next_batch(pending, batch_size, max_wait):
+    """
+    Wait for a first sentence, then wait for at most `max_wait` seconds for more sentences,
+    until there are `batch_size` of them.
+    """
+    batch = [pending.get()]
+    deadline = time.time() + max_wait
+
+    while len(batch) < batch_size:
+        timeout = deadline - time.time()
+        try:
+            batch.append(pending.get(timeout=timeout) if timeout > 0 else pending.get_nowait())
+        except queue.Empty:
+            break
+
+    return batch
+
+
+def serve(decode_fun, port, batch_size=1, max_wait=0.01, host='localhost'):
+    """
+    Start the server, and decode the incoming sentences until interrupted.
+
+    :param decode_fun: function which takes a list of sentences (each sentence is a list
+      of inputs, one for each encoder), and returns the list of their translations
+    :param port: port on which to listen
+    :param batch_size: maximum number of sentences decoded at once
+    :param max_wait: maximum time (in seconds) that a sentence waits for other sentences
+      to fill its batch
+    :param host: address on which to listen
+    """
+    pending = queue.Queue()
+    server = ThreadingHTTPServer((host, port), make_handler(pending))
+
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    utils.log('listening on {}:{}'.format(host, port))
+
+    try:
+        while True:
+            batch = next_batch(pending, batch_size, max_wait)
+            try:
+                outputs = decode_fun([sentence.inputs for sentence in batch])
+                for sentence, output in zip(batch, outputs):
+                    sentence.output = output
+            except Exception as e:
+                utils.warn('decoding error: {}'.format(e))
+                for sentence in batch:
+                    sentence.error = str(e)
+
+            for sentence in batch:
+                sentence.done.set()
+    finally:
+        server.shutdown()
+        server.server_close()
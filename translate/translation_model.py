@@ -5,19 +5,30 @@ import time
 import sys
 import math
 import shutil
-from translate import utils
+import glob
+import threading
+import numbers
+import numpy as np
+from translate import utils, server, preprocessing
 from translate.seq2seq_model import Seq2SeqModel
 import pdb
 
 
 class BaseTranslationModel(object):
-    def __init__(self, name, checkpoint_dir, keep_best=1):
+    def __init__(self, name, checkpoint_dir, keep_best=1, async_save=False):
         self.name = name
         self.keep_best = keep_best
         self.checkpoint_dir = checkpoint_dir
+        self.async_save = async_save
         self.saver = tf.train.Saver(max_to_keep=3, keep_checkpoint_every_n_hours=5)
 
-    def manage_best_checkpoints(self, step, score):
+    def manage_best_checkpoints(self, step, score, checkpoint=None):
+        """
+        :param checkpoint: name of the checkpoint file which corresponds to this step (by default
+          `translate-STEP`)
+        """
+        checkpoint = checkpoint or 'translate-{}'.format(step)
+        self.wait_for_save()
         score_filename = os.path.join(self.checkpoint_dir, 'scores.txt')
         # try loading previous scores
         try:
@@ -33,8 +44,7 @@ class BaseTranslationModel(object):
         best_scores = sorted(scores, reverse=True)[:self.keep_best]
 
         if any(score_ < score for score_, _ in best_scores) or not best_scores:
-            shutil.copy(os.path.join(self.checkpoint_dir, 'translate-{}'.format(step)),
-                        os.path.join(self.checkpoint_dir, 'best-{}'.format(step)))
+            link_checkpoint(self.checkpoint_dir, checkpoint, 'best-{}'.format(step))
 
             if all(score_ < score for score_, _ in best_scores):
                 path = os.path.abspath(os.path.join(self.checkpoint_dir, 'best'))
@@ -49,10 +59,7 @@ class BaseTranslationModel(object):
 
             for _, step_ in best_scores[self.keep_best:]:
                 # remove checkpoints that are not in the top anymore
-                try:
-                    os.remove(os.path.join(self.checkpoint_dir, 'best-{}'.format(step_)))
-                except OSError:
-                    pass
+                remove_checkpoint(self.checkpoint_dir, 'best-{}'.format(step_))
 
         # save bleu scores
         scores.append((score, step))
@@ -72,14 +79,28 @@ class BaseTranslationModel(object):
             load_checkpoint(sess, self.checkpoint_dir, blacklist=blacklist)
 
     def save(self, sess):
+        if self.async_save and not isinstance(self.saver, BackgroundSaver):
+            self.saver = BackgroundSaver(tf.all_variables(), max_to_keep=3, keep_checkpoint_every_n_hours=5)
         save_checkpoint(sess, self.saver, self.checkpoint_dir, self.global_step)
 
+    def wait_for_save(self):
+        """
+        Wait until the last checkpoint is written to disk (when checkpoints are saved in the background)
+        """
+        if isinstance(self.saver, BackgroundSaver):
+            self.saver.wait()
+
 
 class TranslationModel(BaseTranslationModel):
     def __init__(self, name, encoders, decoder, checkpoint_dir, learning_rate,
                  learning_rate_decay_factor, batch_size, keep_best=1,
-                 load_embeddings=None, optimizer='sgd', **kwargs):
+                 load_embeddings=None, optimizer='sgd', prefetch_batches=0, loader_workers=1, batch_tokens=0,
+                 async_save=False, lm_cache_size=64, **kwargs):
         self.batch_size = batch_size
+        self.lm_cache_size = lm_cache_size
+        self.batch_tokens = batch_tokens
+        self.prefetch_batches = prefetch_batches
+        self.loader_workers = loader_workers
         self.src_ext = [encoder.get('ext') or encoder.name for encoder in encoders]
         self.trg_ext = decoder.get('ext') or decoder.name
         self.extensions = self.src_ext + [self.trg_ext]
@@ -87,6 +108,12 @@ class TranslationModel(BaseTranslationModel):
         encoders_and_decoder = encoders + [decoder]
         self.binary_input = [encoder_or_decoder.binary for encoder_or_decoder in encoders_and_decoder]
         self.character_level = [encoder_or_decoder.character_level for encoder_or_decoder in encoders_and_decoder]
+        # raw text processing in `decode` and `serve` (created when needed)
+        self.text_processing = [
+            {k: encoder_or_decoder.get(k) for k in ('tokenize', 'lowercase', 'escape_special_chars', 'subwords')}
+            for encoder_or_decoder in encoders_and_decoder
+        ]
+        self.preprocessors = None
 
         self.learning_rate = tf.Variable(learning_rate, trainable=False, name='learning_rate', dtype=tf.float32)
 
@@ -119,17 +146,43 @@ class TranslationModel(BaseTranslationModel):
         self.model = Seq2SeqModel(encoders, decoder, self.learning_rate, self.global_step, optimizer=optimizer,
                                   **kwargs)
 
-        super(TranslationModel, self).__init__(name, checkpoint_dir, keep_best)
+        super(TranslationModel, self).__init__(name, checkpoint_dir, keep_best, async_save=async_save)
 
         self.batch_iterator = None
         self.dev_batches = None
+        self.reset_metrics()
+
+    def reset_metrics(self):
+        """
+        Reset the values which are used to track the progress of this task (between two checkpoints)
+        """
+        self.loss = 0
+        self.steps = 0
+        self.time = 0  # total time spent in `train_step`
+        self.input_time = 0  # time spent waiting for training batches
+        self.batch_time = 0  # time spent loading and padding the training batches (possibly in the background)
+        self.run_time = 0  # time spent in `session.run`
+        self.src_tokens = 0  # number of source tokens (or frames), without padding
+        self.trg_tokens = 0  # number of target tokens (including EOS), without padding
+        self.padded_tokens = 0  # number of source and target tokens, with padding
 
     def read_data(self, max_train_size, max_dev_size):
         utils.debug('reading training data')
         train_set = utils.read_dataset_list(self.filenames.train, self.extensions, self.vocabs, max_size=max_train_size,
                                        binary_input=self.binary_input, character_level=self.character_level)
         #utils.debug('train_set {}'.format(train_set))
-        self.batch_iterator = utils.read_ahead_batch_iterator_list(train_set, self.batch_size, read_ahead=10)
+        if self.batch_tokens > 0:
+            max_lengths = [self.model.max_input_len] * len(self.src_ext) + [self.model.max_output_len]
+            batch_iterator = utils.token_batch_iterator(train_set, self.batch_tokens, max_lengths=max_lengths)
+        else:
+            batch_iterator = utils.read_ahead_batch_iterator_list(train_set, self.batch_size, read_ahead=10)
+
+        # iterator over the feed dictionaries of the training batches
+        if self.prefetch_batches > 0:
+            self.batch_iterator = utils.prefetch_iterator(batch_iterator, self.prefetch_batches,
+                                                          workers=self.loader_workers, func=self._get_input_feed)
+        else:
+            self.batch_iterator = map(self._get_input_feed, batch_iterator)
 
         utils.debug('reading development data')
         dev_sets = [
@@ -148,13 +201,47 @@ class TranslationModel(BaseTranslationModel):
         ]
         self.src_vocab = self.vocabs[:-1]
         self.trg_vocab = self.vocabs[-1]
-        self.ngrams = self.filenames.lm_path and utils.read_ngrams(self.filenames.lm_path, self.trg_vocab.vocab)
+        if self.filenames.lm_path:
+            self.ngrams = utils.read_language_model(self.filenames.lm_path, self.trg_vocab.vocab,
+                                                    cache_size=self.lm_cache_size)
+        else:
+            self.ngrams = None
 
     def train(self, *args, **kwargs):
         raise NotImplementedError('use MultiTaskModel')
 
+    def _get_input_feed(self, batch):
+        """
+        :return: pair (feed dictionary, statistics about this batch)
+        """
+        start_time = time.time()
+        batch = [utils.read_features_list(inputs) for inputs in batch]
+        input_feed = self.model.get_input_feed(batch)
+
+        encoder_input_length = [input_feed[length] for length in self.model.encoder_input_length]
+        encoder_inputs = [input_feed[inputs] for inputs in self.model.encoder_inputs]
+        decoder_inputs = input_feed[self.model.decoder_inputs]
+
+        stats = dict(
+            batch_time=time.time() - start_time,
+            src_tokens=sum(length.sum() for length in encoder_input_length),
+            trg_tokens=input_feed[self.model.decoder_input_length].sum(),
+            padded_tokens=sum(inputs.shape[0] * inputs.shape[1] for inputs in encoder_inputs) + decoder_inputs.size
+        )
+        return input_feed, stats
+
     def train_step(self, sess):
-        return self.model.step(sess, next(self.batch_iterator)).loss
+        start_time = time.time()
+        input_feed, stats = next(self.batch_iterator)
+        self.input_time += time.time() - start_time
+
+        start_time = time.time()
+        loss = self.model.step(sess, input_feed=input_feed).loss
+        self.run_time += time.time() - start_time
+
+        for key, value in stats.items():
+            setattr(self, key, getattr(self, key) + value)
+        return loss
 
     def eval_step(self, sess):
         # compute perplexity on dev set
@@ -169,33 +256,93 @@ class TranslationModel(BaseTranslationModel):
             utils.log("  eval: perplexity {:.2f}".format(perplexity))
 
     def _decode_sentence(self, sess, src_sentences, beam_size=1, remove_unk=False):
+        return self._decode_batch(sess, [src_sentences], beam_size, remove_unk)[0]
+
+    def _decode_batch(self, sess, sentence_tuples, beam_size=1, remove_unk=False, decode_batch_size=None):
+        """
+        Decode a list of inputs, `decode_batch_size` inputs at a time. The inputs are sorted
+        by length, so that each batch contains sequences of similar lengths (less padding).
+
+        :param sentence_tuples: list of tuples of inputs (one input for each encoder)
+        :param decode_batch_size: number of sentences decoded at once (all at once if None)
+        :return: list of output sentences, in the same order as the inputs
+        """
         # TODO: merge this with read_dataset
         token_ids = [
-            utils.sentence_to_token_ids(sentence, vocab.vocab, character_level=char_level)
-            if vocab is not None else sentence  # when `sentence` is not a sentence but a vector...
-            for vocab, sentence, char_level in zip(self.vocabs, src_sentences, self.character_level)
+            [
+                utils.sentence_to_token_ids(sentence, vocab.vocab, character_level=char_level)
+                if vocab is not None else sentence  # when `sentence` is not a sentence but a vector...
+                for vocab, sentence, char_level in zip(self.vocabs, src_sentences, self.character_level)
+            ]
+            for src_sentences in sentence_tuples
         ]
 
-        if beam_size <= 1 and not isinstance(sess, list):
-            trg_token_ids, _ = self.model.greedy_decoding(sess, token_ids)
-        else:
-            hypotheses, scores = self.model.beam_search_decoding(sess, token_ids, beam_size, ngrams=self.ngrams)
-            trg_token_ids = hypotheses[0]  # first hypothesis is the highest scoring one
+        order = sorted(range(len(token_ids)), key=lambda i: [len(input_) for input_ in token_ids[i]])
+        batch_token_ids = [None] * len(token_ids)
 
-        # remove EOS symbols from output
-        if utils.EOS_ID in trg_token_ids:
-            trg_token_ids = trg_token_ids[:trg_token_ids.index(utils.EOS_ID)]
+        for batch_ids in utils.sequential_batch_iterator(order, decode_batch_size or len(order)):
+            batch = [token_ids[i] for i in batch_ids]
 
-        trg_tokens = [self.trg_vocab.reverse[i] if i < len(self.trg_vocab.reverse) else utils._UNK
-                      for i in trg_token_ids]
+            if beam_size <= 1 and not isinstance(sess, list):
+                outputs, _ = self.model.batch_greedy_decoding(sess, batch)
+            else:
+                results = self.model.batch_beam_search_decoding(sess, batch, beam_size, ngrams=self.ngrams)
+                # first hypothesis is the highest scoring one
+                outputs = [hypotheses[0] for hypotheses, _ in results]
 
-        if remove_unk:
-            trg_tokens = [token for token in trg_tokens if token != utils._UNK]
+            for i, trg_token_ids in zip(batch_ids, outputs):  # restore the original order
+                batch_token_ids[i] = trg_token_ids
 
-        if self.character_level[-1]:
-            return ''.join(trg_tokens)
-        else:
-            return ' '.join(trg_tokens).replace('@@ ', '')  # merge subword units
+        trg_sentences = []
+        for trg_token_ids in batch_token_ids:
+            # remove EOS symbols from output
+            if utils.EOS_ID in trg_token_ids:
+                trg_token_ids = trg_token_ids[:trg_token_ids.index(utils.EOS_ID)]
+
+            trg_tokens = [self.trg_vocab.reverse[i] if i < len(self.trg_vocab.reverse) else utils._UNK
+                          for i in trg_token_ids]
+
+            if remove_unk:
+                trg_tokens = [token for token in trg_tokens if token != utils._UNK]
+
+            if self.character_level[-1]:
+                trg_sentences.append(''.join(trg_tokens))
+            else:
+                trg_sentences.append(' '.join(trg_tokens).replace('@@ ', ''))  # merge subword units
+
+        return trg_sentences
+
+    def _get_preprocessors(self, script_dir='scripts'):
+        """
+        Create the pipelines which convert the raw inputs of `decode` and `serve` to the format
+        of the training data (one for each encoder), and the outputs back to raw text (last one)
+        """
+        if self.preprocessors is None:
+            self.preprocessors = [
+                preprocessing.Preprocessor(ext, tokenize=options['tokenize'], lowercase=options['lowercase'],
+                                           escape_special_chars=options['escape_special_chars'],
+                                           bpe_codes=bpe_codes if options['subwords'] else None,
+                                           script_dir=script_dir)
+                if not binary else None
+                # the output subwords are merged by `_decode_batch`, so the decoder doesn't need BPE codes
+                for ext, options, bpe_codes, binary in zip(self.extensions, self.text_processing,
+                                                           self.filenames.bpe[:-1] + [None], self.binary_input)
+            ]
+        return self.preprocessors
+
+    def _decode_raw_batch(self, sess, sentence_tuples, beam_size=1, remove_unk=False, decode_batch_size=None,
+                          script_dir='scripts'):
+        """
+        Same as `_decode_batch`, but with pre-processing of the inputs and post-processing of the outputs
+        """
+        preprocessors = self._get_preprocessors(script_dir)
+        sentence_tuples = [
+            [preprocessor.preprocess(sentence) if preprocessor is not None else sentence
+             for preprocessor, sentence in zip(preprocessors, src_sentences)]
+            for src_sentences in sentence_tuples
+        ]
+        trg_sentences = self._decode_batch(sess, sentence_tuples, beam_size, remove_unk, decode_batch_size)
+        return [preprocessors[-1].postprocess(trg_sentence) for trg_sentence in trg_sentences]
 
     def align(self, sess, output=None, wav_files=None, **kwargs):
         if len(self.src_ext) != 1:
@@ -232,7 +379,8 @@ class TranslationModel(BaseTranslationModel):
             output_file = '{}.{}.svg'.format(output, line_id + 1) if output is not None else None
             utils.heatmap(src_tokens, trg_tokens, weights.T, wav_file=wav_file, output_file=output_file)
 
-    def decode(self, sess, beam_size, output=None, remove_unk=False, **kwargs):
+    def decode(self, sess, beam_size, output=None, remove_unk=False, decode_batch_size=1, script_dir='scripts',
+               **kwargs):
         utils.log('starting decoding')
 
         # empty `test` means that we read from standard input, which is not possible with multiple encoders
@@ -246,16 +394,43 @@ class TranslationModel(BaseTranslationModel):
         try:
             output_file = sys.stdout if output is None else open(output, 'w')
 
-            for lines in utils.read_lines(self.filenames.test, self.src_ext, self.binary_input):
-                trg_sentence = self._decode_sentence(sess, lines, beam_size, remove_unk)
-                output_file.write(trg_sentence + '\n')
+            lines = utils.read_lines(self.filenames.test, self.src_ext, self.binary_input, stream=True)
+            if not self.filenames.test:  # interactive mode: decode each line as soon as it is read
+                decode_batch_size = 1
+
+            # read several batches ahead of time, and sort them by length
+            read_ahead = 10 * decode_batch_size if decode_batch_size > 1 else 1
+
+            for batch in utils.sequential_batch_iterator(lines, read_ahead):
+                for trg_sentence in self._decode_raw_batch(sess, batch, beam_size, remove_unk, decode_batch_size,
+                                                           script_dir):
+                    output_file.write(trg_sentence + '\n')
                 output_file.flush()
         finally:
             if output_file is not None:
                 output_file.close()
 
+    def serve(self, sess, beam_size, remove_unk=False, decode_batch_size=1, serve_port=8000, serve_max_wait=0.01,
+              script_dir='scripts', **kwargs):
+        """
+        Keep the model in memory, and decode the sentences received over HTTP (see `translate.server`)
+
+        :param decode_batch_size: maximum number of sentences (from all pending requests) decoded at once
+        :param serve_port: port on which to listen
+        :param serve_max_wait: maximum time (in seconds) to wait for other requests before decoding a batch
+        """
+        # we can't receive binary data (only sentences)
+        assert not any(self.binary_input[:-1])
+
+        def decode_fun(sentence_tuples):
+            return self._decode_raw_batch(sess, sentence_tuples, beam_size, remove_unk, decode_batch_size,
+                                          script_dir)
+
+        server.serve(decode_fun, port=serve_port, batch_size=decode_batch_size, max_wait=serve_max_wait)
+
     def evaluate(self, sess, beam_size, score_function, on_dev=True, output=None, remove_unk=False,
-                 auxiliary_score_function=None, script_dir='scripts', **kwargs):
+                 auxiliary_score_function=None, script_dir='scripts', decode_batch_size=1, partial_score_every=0,
+                 **kwargs):
         """
         :param score_function: name of the scoring function used to score and rank models
           (typically 'bleu_score')
@@ -265,6 +440,10 @@ class TranslationModel(BaseTranslationModel):
         :param auxiliary_score_function: optional scoring function used to display a more
           detailed summary.
         :param script_dir: parameter of scoring functions
+        :param decode_batch_size: number of sentences to decode at once
+        :param partial_score_every: log the score of the sentences decoded so far every time this
+          number of sentences is decoded (only for scoring functions which can be computed incrementally,
+          see `utils.incremental_score_functions`)
         :return: scores of each corpus to evaluate
         :Chunlei updated for stream mode, 1/9/2017
         """
@@ -281,38 +460,62 @@ class TranslationModel(BaseTranslationModel):
 
         scores = []
 
+        incremental = utils.incremental_score_functions.get(score_function)
+        # the hypotheses and references need to be kept until the end, unless all the scores
+        # can be computed incrementally
+        keep_sentences = incremental is None or auxiliary_score_function not in (None, score_function)
+
         for filenames_, output_ in zip(filenames, output):  # evaluation on multiple corpora
-            lines = list(utils.read_lines_list(filenames_, self.extensions, binary_input=False))
-            
-            #utils.log('lines {}'.format(lines))
-            big_batches_ = []
-            for i in range(len(lines)):
-                big_batches_.append([])
-                tmp_list = lines[i][0]
-                #debug('i: {}'.format(i))
-                big_batches_[i].append(utils.read_binary_features_list(tmp_list.strip()))
-                big_batches_[i].append(lines[i][1])
-            
+            # lines are read as they are needed, and features are only loaded for the current batches
+            lines = utils.read_lines_list(filenames_, self.extensions, binary_input=self.binary_input)
+
             hypotheses = []
             references = []
+            sentence_count = 0
+            if incremental is not None:
+                stats = incremental[0]('', '')  # all zeros
 
             try:
                 output_file = open(output_, 'w') if output_ is not None else None
 
-                for *src_sentences, trg_sentence in big_batches_:
-                    hypotheses.append(self._decode_sentence(sess, src_sentences, beam_size, remove_unk))
-                    references.append(trg_sentence.strip().replace('@@ ', ''))
+                # read several batches ahead of time, and sort them by length
+                read_ahead = 10 * decode_batch_size if decode_batch_size > 1 else 1
+
+                for batch in utils.sequential_batch_iterator(lines, read_ahead):
+                    batch = [utils.read_features_list(lines_, self.binary_input) for lines_ in batch]
+                    src_sentences = [lines_[:-1] for lines_ in batch]
+                    trg_sentences = [lines_[-1] for lines_ in batch]
+
+                    hypotheses_ = self._decode_batch(sess, src_sentences, beam_size, remove_unk, decode_batch_size)
+                    references_ = [trg_sentence.strip().replace('@@ ', '') for trg_sentence in trg_sentences]
                     if output_file is not None:
-                        output_file.write(hypotheses[-1] + '\n')
+                        output_file.writelines(hypothesis + '\n' for hypothesis in hypotheses_)
                         output_file.flush()
 
+                    if keep_sentences:
+                        hypotheses += hypotheses_
+                        references += references_
+
+                    if incremental is not None:
+                        for hypothesis, reference in zip(hypotheses_, references_):
+                            stats += incremental[0](hypothesis, reference)
+
+                        previous_count, sentence_count = sentence_count, sentence_count + len(batch)
+                        if partial_score_every and previous_count // partial_score_every < (
+                                sentence_count // partial_score_every):
+                            partial_score, _ = incremental[1](stats)
+                            utils.log('{} sentences partial score={}'.format(sentence_count, partial_score))
+
             finally:
                 if output_file is not None:
                     output_file.close()
 
             # main scoring function (used to choose which checkpoints to keep)
             # default is utils.bleu_score
-            score, score_summary = getattr(utils, score_function)(hypotheses, references, script_dir)
+            if incremental is not None:
+                score, score_summary = incremental[1](stats)
+            else:
+                score, score_summary = getattr(utils, score_function)(hypotheses, references, script_dir)
 
             # optionally use an auxiliary function to get different scoring information
             if auxiliary_score_function is not None and auxiliary_score_function != score_function:
@@ -378,11 +581,99 @@ def save_checkpoint(sess, saver, checkpoint_dir, step=None, name=None):
         utils.log("creating directory {}".format(checkpoint_dir))
         os.makedirs(checkpoint_dir)
 
-    with open(var_file, 'wb') as f:
-        var_names = [var.name for var in tf.all_variables()]
-        pickle.dump(var_names, f)
+    var_names = [var.name for var in tf.all_variables()]
+    try:
+        with open(var_file, 'rb') as f:
+            var_file_changed = pickle.load(f) != var_names
+    except (IOError, EOFError, pickle.UnpicklingError):
+        var_file_changed = True
+
+    if var_file_changed:
+        with open(var_file, 'wb') as f:
+            pickle.dump(var_names, f)
 
     utils.log('saving model to {}'.format(checkpoint_dir))
     checkpoint_path = os.path.join(checkpoint_dir, name)
     saver.save(sess, checkpoint_path, step, write_meta_graph=False)
     utils.log('finished saving model')
+
+
+class BackgroundSaver(object):
+    """
+    Same interface as `tf.train.Saver`, except that checkpoints are written to disk by a background thread.
+    The values of the variables are fetched from the session (which is fast), and written to disk by
+    another saver, which lives in a separate graph (with copies of the variables, on CPU) and session.
+    """
+
+    def __init__(self, variables, **kwargs):
+        self.variables = variables
+        self.graph = tf.Graph()
+        self.thread = None
+
+        with self.graph.as_default(), tf.device('/cpu:0'):
+            self.placeholders = []
+            self.initializers = []
+            var_list = {}
+            for var in variables:
+                placeholder = tf.placeholder(var.dtype.base_dtype, shape=var.get_shape())
+                var_ = tf.Variable(placeholder, trainable=False)
+                self.placeholders.append(placeholder)
+                self.initializers.append(var_.initializer)
+                var_list[var.op.name] = var_  # same names as in the main graph
+
+            self.saver = tf.train.Saver(var_list, **kwargs)
+
+        self.session = tf.Session(graph=self.graph, config=tf.ConfigProto(device_count={'GPU': 0}))
+
+    def save(self, sess, save_path, global_step=None, write_meta_graph=False):
+        values = sess.run(self.variables)
+        if isinstance(global_step, (numbers.Integral, np.integer)):
+            global_step = int(global_step)
+        elif global_step is not None:  # tensor or variable
+            global_step = tf.train.global_step(sess, global_step)
+
+        self.wait()  # only one checkpoint is written at a time
+
+        def save():
+            self.session.run(self.initializers, feed_dict=dict(zip(self.placeholders, values)))
+            path = self.saver.save(self.session, save_path, global_step, write_meta_graph=write_meta_graph)
+            utils.debug('finished writing {}'.format(path))
+
+        # this thread is not a daemon, so that the program waits for the checkpoint to be written before exiting
+        self.thread = threading.Thread(target=save)
+        self.thread.start()
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+
+def checkpoint_files(checkpoint_dir, name):
+    """
+    Files which belong to checkpoint `name` (e.g. `translate-STEP`, `translate-STEP.meta`)
+    """
+    path = os.path.join(checkpoint_dir, name)
+    return [filename for filename in [path] + glob.glob(path + '.*') if os.path.isfile(filename)]
+
+
+def link_checkpoint(checkpoint_dir, name, new_name):
+    """
+    Give another name to checkpoint `name` (hard links, or copies if links are not supported),
+    which stays available even when the training process removes the original checkpoint.
+    """
+    for filename in checkpoint_files(checkpoint_dir, name):
+        new_filename = os.path.join(checkpoint_dir, new_name + filename[len(os.path.join(checkpoint_dir, name)):])
+        try:
+            os.remove(new_filename)
+        except OSError:
+            pass
+        try:
+            os.link(filename, new_filename)
+        except OSError:
+            shutil.copy(filename, new_filename)
+
+
+def remove_checkpoint(checkpoint_dir, name):
+    for filename in checkpoint_files(checkpoint_dir, name):
+        os.remove(filename)
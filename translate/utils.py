@@ -9,8 +9,16 @@ import struct
 import random
 import math
 import wave
-
-from collections import namedtuple
+import queue
+import threading
+import itertools
+import array
+import functools
+import hashlib
+import json
+import time
+
+from collections import namedtuple, OrderedDict, Counter
 from contextlib import contextmanager
 
 # special vocabulary symbols
@@ -84,6 +92,82 @@ def initialize_vocabulary(vocabulary_path):
         raise ValueError("vocabulary file %s not found", vocabulary_path)
 
 
+def hash_vocabulary(vocabulary):
+    """
+    Fingerprint of a vocabulary (used as a key for the files that contain token ids).
+
+    :param vocabulary: a dictionary mapping tokens to integers
+    :return: a string (hexadecimal MD5 digest)
+    """
+    tokens = sorted(vocabulary.items(), key=lambda item: item[1])
+    return hashlib.md5('\n'.join(token for token, _ in tokens).encode()).hexdigest()
+
+
+def save_arrays(filename, arrays, **meta):
+    """
+    Save a dict of numpy arrays to a single binary file, which can be memory-mapped by `load_arrays`.
+    The file starts with the length (int64) of a JSON header, which contains `meta` and the
+    data type, shape and position of each array.
+
+    :param filename: path to the output file
+    :param arrays: dict mapping names to numpy arrays
+    :param meta: additional (JSON serializable) information to store in the header
+    """
+    arrays = dict((name, np.ascontiguousarray(array_)) for name, array_ in arrays.items())
+
+    header = dict(meta=meta, arrays={})
+    for name, array_ in arrays.items():
+        header['arrays'][name] = dict(dtype=array_.dtype.str, shape=array_.shape)
+
+    # the position of the arrays depends on the size of the header, which depends on those positions
+    header_size = 0
+    while True:
+        offset = 8 + header_size
+        for name in sorted(arrays):
+            offset += -offset % 64  # align arrays on 64 bytes
+            header['arrays'][name]['offset'] = offset
+            offset += arrays[name].nbytes
+        header_ = json.dumps(header).encode()
+        if len(header_) <= header_size:
+            break
+        header_size = len(header_) + 16
+
+    # write to a temporary file first, so that concurrent readers never see a partial file
+    tmp_filename = '{}.tmp{}'.format(filename, os.getpid())
+    with open(tmp_filename, 'wb') as f:
+        f.write(struct.pack('q', header_size))
+        f.write(header_.ljust(header_size))
+        for name in sorted(arrays):
+            f.seek(header['arrays'][name]['offset'])
+            f.write(arrays[name].tobytes())
+    os.rename(tmp_filename, filename)
+
+
+def load_arrays(filename, mmap=True):
+    """
+    Load a file created by `save_arrays`.
+
+    :param filename: path to the file
+    :param mmap: memory-map the arrays instead of reading them
+    :return: pair (dict of arrays, meta information)
+    """
+    with open(filename, 'rb') as f:
+        header_size, = struct.unpack('q', f.read(8))
+        header = json.loads(f.read(header_size).decode())
+
+        arrays = {}
+        for name, info in header['arrays'].items():
+            dtype, shape = np.dtype(info['dtype']), tuple(info['shape'])
+            if not mmap or np.prod(shape) == 0:
+                f.seek(info['offset'])
+                array_ = np.fromfile(f, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+            else:
+                array_ = np.memmap(filename, dtype=dtype, mode='r', offset=info['offset'], shape=shape)
+            arrays[name] = array_
+
+    return arrays, header['meta']
+
+
 def sentence_to_token_ids(sentence, vocabulary, character_level=False):
     """
     Convert a string to list of integers representing token-ids.
@@ -102,8 +186,56 @@ def sentence_to_token_ids(sentence, vocabulary, character_level=False):
     return [vocabulary.get(w, UNK_ID) for w in sentence]
 
 
+def read_token_ids(filename, vocabulary, character_level=False):
+    """
+    Convert a whole text corpus to token ids (see `sentence_to_token_ids`).
+
+    The result is saved to a binary file (`FILENAME.VOCAB_HASH.ids`), which is memory-mapped
+    by the next calls (as long as the corpus and the vocabulary don't change).
+
+    :param filename: path to the corpus (one sentence per line)
+    :param vocabulary: a dictionary mapping tokens to integers
+    :param character_level: treat sentences as strings of characters
+    :return: pair (ids, offsets), where `ids` is an int32 array containing the token ids of all
+      the sentences, and `offsets` an int64 array containing the position of each sentence in
+      `ids`, plus the total length (sentence i is `ids[offsets[i]:offsets[i + 1]]`)
+    """
+    vocab_hash = hash_vocabulary(vocabulary)
+    cache_path = '{}.{}.ids'.format(filename, vocab_hash[:10])
+    stat = os.stat(filename)
+    key = dict(source_size=stat.st_size, source_mtime=stat.st_mtime, vocab_hash=vocab_hash,
+               character_level=bool(character_level))
+
+    if os.path.exists(cache_path):
+        arrays, meta = load_arrays(cache_path)
+        if all(meta.get(k) == v for k, v in key.items()):
+            debug('loading token ids from {}'.format(cache_path))
+            return arrays['ids'], arrays['offsets']
+
+    ids = array.array('i')
+    offsets = array.array('q', [0])
+
+    with open(filename) as f:
+        for counter, line in enumerate(f, 1):
+            if counter % 100000 == 0:
+                log("  converting line {}".format(counter))
+            ids.extend(sentence_to_token_ids(line, vocabulary, character_level=character_level))
+            offsets.append(len(ids))
+
+    ids = np.frombuffer(ids, dtype=np.int32)
+    offsets = np.frombuffer(offsets, dtype=np.int64)
+
+    try:
+        save_arrays(cache_path, dict(ids=ids, offsets=offsets), **key)
+        debug('saved token ids to {}'.format(cache_path))
+    except IOError:
+        warn('could not save token ids to {}'.format(cache_path))
+
+    return ids, offsets
+
+
 def get_filenames(data_dir, extensions, train_prefix, dev_prefix, vocab_prefix,
-                  embedding_prefix, lm_file=None, **kwargs):
+                  embedding_prefix, lm_file=None, bpe_prefix='bpe', **kwargs):
     """
     Get a bunch of file prefixes and extensions, and output the list of filenames to be used
     by the model.
@@ -115,6 +247,7 @@ def get_filenames(data_dir, extensions, train_prefix, dev_prefix, vocab_prefix,
     :param vocab_prefix: prefix of the vocab files (usually 'vocab')
     :param embedding_prefix: prefix of the embedding files
     :param lm_file: full path to a language model file in the ARPA format
+    :param bpe_prefix: prefix of the BPE codes files (usually 'bpe')
     :param kwargs: optional contains an additional 'decode', 'eval' or 'align' parameter
     :return: namedtuple containing the filenames
     """
@@ -128,14 +261,15 @@ def get_filenames(data_dir, extensions, train_prefix, dev_prefix, vocab_prefix,
     dev = [['{}.{}'.format(path, ext) for ext in extensions] for path in dev_path]
     vocab = ['{}.{}'.format(vocab_path, ext) for ext in extensions]
     embeddings = ['{}.{}'.format(embedding_path, ext) for ext in extensions]
+    bpe = ['{}.{}'.format(os.path.join(data_dir, bpe_prefix), ext) for ext in extensions]
 
     test = kwargs.get('decode')  # empty list means we decode from standard input
     if test is None:
         test = test or kwargs.get('eval')
         test = test or kwargs.get('align')
 
-    filenames = namedtuple('filenames', ['train', 'dev', 'test', 'vocab', 'lm_path', 'embeddings'])
-    return filenames(train, dev, test, vocab, lm_path, embeddings)
+    filenames = namedtuple('filenames', ['train', 'dev', 'test', 'vocab', 'lm_path', 'embeddings', 'bpe'])
+    return filenames(train, dev, test, vocab, lm_path, embeddings, bpe)
 
 
 def bleu_score(hypotheses, references, script_dir):
@@ -155,7 +289,8 @@ def bleu_score(hypotheses, references, script_dir):
     try:
         p = subprocess.Popen([bleu_script, f.name], stdin=subprocess.PIPE,
                              stdout=subprocess.PIPE, stderr=open('/dev/null', 'w'))
-        output, _ = p.communicate('\n'.join(hypotheses).encode())
+        # the script removes the last character of each line, so the last line needs a newline
+        output, _ = p.communicate(''.join(hypothesis + '\n' for hypothesis in hypotheses).encode())
     finally:
         os.unlink(f.name)
 
@@ -167,6 +302,116 @@ def bleu_score(hypotheses, references, script_dir):
     return bleu, 'penalty={} ratio={}'.format(penalty, ratio)
 
 
+def bleu_stats(hypothesis, reference, max_order=4):
+    """
+    Sufficient statistics for computing the BLEU score of a corpus (the statistics
+    of a corpus are the sum of the statistics of its sentences). Sentences are split on
+    ASCII whitespaces, like in 'multi-bleu.perl'.
+
+    :param hypothesis: translation hypothesis
+    :param reference: translation reference
+    :param max_order: maximum n-gram order
+    :return: int64 array containing the number of matching n-grams for each order, the total number
+      of n-grams in the hypothesis for each order, the hypothesis length, and the reference length
+    """
+    hyp_words = hypothesis.encode().split()
+    ref_words = reference.encode().split()
+
+    stats = np.zeros(2 * max_order + 2, dtype=np.int64)
+    for n in range(1, max_order + 1):
+        hyp_ngrams = Counter(zip(*[hyp_words[i:] for i in range(n)]))
+        ref_ngrams = Counter(zip(*[ref_words[i:] for i in range(n)]))
+        stats[n - 1] = sum((hyp_ngrams & ref_ngrams).values())  # clipped counts
+        stats[max_order + n - 1] = max(len(hyp_words) - n + 1, 0)
+
+    stats[-2:] = len(hyp_words), len(ref_words)
+    return stats
+
+
+def _bleu_stats(args):
+    return bleu_stats(*args)
+
+
+def corpus_bleu_stats(hypotheses, references, processes=1):
+    """
+    Sum of the BLEU statistics of each sentence (see `bleu_stats`).
+
+    :param hypotheses: list of translation hypotheses
+    :param references: list of translation references
+    :param processes: number of worker processes to use (useful for large corpora)
+    """
+    if processes > 1:
+        import multiprocessing
+        with multiprocessing.Pool(processes) as pool:
+            stats = pool.map(_bleu_stats, zip(hypotheses, references), chunksize=1000)
+    else:
+        stats = map(_bleu_stats, zip(hypotheses, references))
+
+    return sum(stats, np.zeros(10, dtype=np.int64))
+
+
+def bleu_from_stats(stats):
+    """
+    Compute the BLEU score from corpus statistics (see `bleu_stats`), with exactly
+    the same formula and rounding as 'multi-bleu.perl'.
+
+    :param stats: statistics of the corpus
+    :return: tuple (BLEU score, brevity penalty, length ratio)
+    """
+    max_order = (len(stats) - 2) // 2
+    correct, total = stats[:max_order], stats[max_order:2 * max_order]
+    hyp_len, ref_len = int(stats[-2]), int(stats[-1])
+
+    if ref_len == 0:
+        return 0.0, 0.0, 0.0
+
+    precisions = [float(correct_) / total_ if total_ else 0 for correct_, total_ in zip(correct, total)]
+    log_precisions = [math.log(p) if p else -9999999999 for p in precisions]
+
+    if hyp_len == 0:
+        penalty = 0.0
+    elif hyp_len < ref_len:
+        penalty = math.exp(1 - ref_len / hyp_len)
+    else:
+        penalty = 1.0
+
+    bleu = penalty * math.exp(sum(log_precisions) / max_order)
+
+    return (float('{:.2f}'.format(100 * bleu)), float('{:.3f}'.format(penalty)),
+            float('{:.3f}'.format(hyp_len / ref_len)))
+
+
+def native_bleu_score(hypotheses, references, script_dir=None, processes=1):
+    """
+    Scoring function which computes the same BLEU score as 'multi-bleu.perl',
+    without calling any external script.
+
+    :param hypotheses: list of translation hypotheses
+    :param references: list of translation references
+    :param script_dir: unused (same interface as the other scoring functions)
+    :param processes: number of worker processes used to compute the statistics
+    :return: a pair (BLEU score, additional scoring information)
+    """
+    return native_bleu_from_stats(corpus_bleu_stats(hypotheses, references, processes))
+
+
+def native_bleu_from_stats(stats):
+    """
+    Same as `native_bleu_score`, but from the statistics of the corpus (see `bleu_stats`)
+
+    :return: a pair (BLEU score, additional scoring information)
+    """
+    bleu, penalty, ratio = bleu_from_stats(stats)
+    return bleu, 'penalty={} ratio={}'.format(penalty, ratio)
+
+
+# scoring functions which can be computed incrementally, from the sum of per-sentence statistics:
+# name -> (function computing the statistics of a sentence pair, function computing the score from those statistics)
+incremental_score_functions = {
+    'native_bleu_score': (bleu_stats, native_bleu_from_stats)
+}
+
+
 def multi_score(hypotheses, references, script_dir):
     """
     Scoring function which calls the 'score.py' script, to get
@@ -244,7 +489,7 @@ def read_embeddings(embedding_filenames, encoders_and_decoder, load_embeddings,
         encoder_or_decoder.embedding = embedding
 
 
-def read_binary_features(filename):
+def read_binary_features(filename, lazy=False):
     """
     Reads a binary file containing vector features. First two (int32) numbers correspond to
     number of entries (lines), and dimension of the vectors.
@@ -254,19 +499,31 @@ def read_binary_features(filename):
     Use `scripts/extract-audio-features.py` to create such a file for audio (MFCCs).
 
     :param filename: path to the binary file containing the features
-    :return: list of arrays of shape (frames, dimension)
+    :param lazy: only read the position of each entry, and memory-map the file, instead
+      of loading all the features at once (see `BinaryFeatures`)
+    :return: list of float32 arrays of shape (frames, dimension)
     """
-    all_feats = []
+    if lazy:
+        return BinaryFeatures(filename)
+    else:
+        return list(iter_binary_features(filename))
+
+
+def iter_binary_features(filename):
+    """
+    Read the entries of a binary feature file (see `read_binary_features`) one by one,
+    as they are needed. Contrary to `BinaryFeatures`, this does not need to go through the
+    whole file before returning the first entry.
 
+    :param filename: path to the binary file containing the features
+    :return: generator of float32 arrays of shape (frames, dimension)
+    """
     with open(filename, 'rb') as f:
         lines, dim = struct.unpack('ii', f.read(8))
         for _ in range(lines):
-            frames, = struct.unpack('i', f.read(4))
-            n = frames * dim
-            feats = struct.unpack('f' * n, f.read(4 * n))
-            all_feats.append(list(np.array(feats).reshape(frames, dim)))
-
-    return all_feats
+            frames, = np.fromfile(f, dtype=np.int32, count=1)
+            feats = np.fromfile(f, dtype=np.float32, count=frames * dim)
+            yield feats.reshape(frames, dim)
 
 
 def read_dataset(paths, extensions, vocabs, max_size=None, binary_input=None,
@@ -289,7 +546,7 @@ def read_dataset(paths, extensions, vocabs, max_size=None, binary_input=None,
             for input_, vocab, ext, char_level in zip(inputs, vocabs, extensions, character_level)
             ]
 
-        if not all(inputs):  # skip empty inputs
+        if not all(len(input_) > 0 for input_ in inputs):  # skip empty inputs
             continue
 
         data_set.append(inputs)  # TODO: filter too long
@@ -305,50 +562,145 @@ def read_dataset(paths, extensions, vocabs, max_size=None, binary_input=None,
 
 def read_dataset_list(paths, extensions, vocabs, max_size=None, binary_input=None,
                  character_level=None, sort_by_length=False):
-    data_set = []
-    #debug('what is paths: {}'.format(paths[1]))
-    line_reader = read_lines_list(paths, extensions, binary_input=False)
+    """
+    Read a parallel corpus into a `Dataset`. Text inputs are converted to token ids once and for all
+    (see `read_token_ids`), binary inputs are given as a list of feature files (list layout),
+    which may have been packed (see `read_lines_list`).
+
+    :return: a `Dataset`, whose examples are lists of inputs (one for each encoder and decoder).
+      Empty examples are skipped.
+    """
+    binary_input = binary_input or [False] * len(extensions)
     character_level = character_level or [False] * len(extensions)
-    #debug('print character_level: {}'.format(character_level))
 
-    for counter, inputs in enumerate(line_reader, 1):
-        if max_size and counter > max_size:
-            break
-        if counter % 100000 == 0:
-            log("  reading data line {}".format(counter))
+    columns = []
+    for path, vocab, binary, char_level in zip(paths, vocabs, binary_input, character_level):
+        if vocab is not None and not binary:
+            column = TokenIds(*read_token_ids(path, vocab.vocab, character_level=char_level))
+        elif binary:
+            column = read_packed_features(path)
+            if column is None:
+                with open(path) as f:
+                    column = FeatureFileList(f.readlines())
+        else:
+            with open(path) as f:
+                column = f.readlines()
+        columns.append(column)
+
+    dataset = Dataset(columns, max_size=max_size)
 
-        inputs = [
-            sentence_to_token_ids(input_, vocab.vocab, character_level=char_level)
-            if vocab is not None and isinstance(input_, str)
-            else input_
-            for input_, vocab, ext, char_level in zip(inputs, vocabs, extensions, character_level)
-            ]
+    debug('files: {}'.format(' '.join(paths)))
+    debug('size: {}'.format(len(dataset)))
 
-        if not all(inputs):  # skip empty inputs
-            continue
+    return dataset
 
-        data_set.append(inputs)  # TODO: filter too long
-        #debug('what is inputs: {}'.format(inputs[0]))
 
-    debug('files: {}'.format(' '.join(paths)))
-    debug('size: {}'.format(len(data_set)))
+class TokenIds(object):
+    """
+    Sentences stored as token ids in a flat array (see `read_token_ids`)
+    """
 
-#    if sort_by_length:
-#        data_set.sort(key=lambda lines: list(map(len, lines)))
+    def __init__(self, ids, offsets):
+        self.ids = ids
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.ids[self.offsets[i]:self.offsets[i + 1]]
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+
+class FeatureFileList(list):
+    """
+    List of paths to feature files (list layout), one per line (see `read_binary_features_list`).
+    The paths are loaded by the consumer of the batches (see `read_features_list`).
+    """
+
+    def lengths(self):
+        """
+        Number of frames of each feature file (read from the header of the file)
+        """
+        lengths = np.zeros(len(self), dtype=np.int64)
+        for i, path in enumerate(self):
+            with open(path.strip(), 'rb') as f:
+                lengths[i] = np.fromfile(f, dtype=np.int32, count=3)[2]
+        return lengths
+
+
+class Dataset(object):
+    """
+    Parallel corpus made of columns (one for each encoder and decoder), which contain the inputs of
+    each line of the corpus: `TokenIds`, `BinaryFeatures`, `FeatureFileList`, or lists.
+    Examples are stored as an array of line numbers, which can be shuffled or sorted without
+    touching the data, and their lengths are stored in an array of shape (examples, columns).
+
+    Lengths are numbers of tokens for text inputs, and numbers of frames for features (whether
+    they are packed in a `BinaryFeatures` file, or given as a `FeatureFileList`), so both feature
+    layouts give the same lengths, and skip the same examples (those with an empty input).
+    """
+
+    def __init__(self, columns, indices=None, max_size=None):
+        """
+        :param columns: list of columns (which must support `len` and random access)
+        :param indices: line numbers of the examples (by default all the non-empty lines)
+        :param max_size: only keep examples from the first `max_size` lines
+        """
+        self.columns = columns
+        lengths = np.stack([self._column_lengths(column) for column in columns], axis=1)
+
+        if indices is None:
+            if max_size:
+                lengths = lengths[:max_size]
+            indices = np.flatnonzero(np.all(lengths > 0, axis=1))  # skip empty inputs
+
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.lengths = lengths[self.indices]
+
+    @staticmethod
+    def _column_lengths(column):
+        if isinstance(column, (TokenIds, FeatureFileList)):
+            return column.lengths()
+        elif isinstance(column, BinaryFeatures):
+            return column.index[:, 1]
+        else:
+            return np.array([len(input_.strip()) if isinstance(input_, str) else len(input_) for input_ in column],
+                            dtype=np.int64)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, i):
+        line_id = self.indices[i]
+        return [column[line_id] for column in self.columns]
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
 
-    return data_set
 
 def read_lines_list(paths, extensions, binary_input=None):
+    """
+    Same as `read_lines`, except that binary inputs are given as a list of feature files
+    (one path per line). If this list was packed with `scripts/pack-audio-features.py` (and the
+    packed file is up to date), the features are read from the packed file instead (memory-mapped), otherwise
+    the paths are returned as is, and the features are loaded on demand (see `read_features_list`).
+    """
     binary_input = binary_input or [False] * len(extensions)
 
     if not paths:  # read from stdin (only works with one encoder with text input)
         assert len(extensions) == 1 and not any(binary_input)
         paths = [None]
 
-    iterators = [
-        sys.stdin if filename is None else read_binary_features(filename) if binary else open(filename)
-        for ext, filename, binary in zip(extensions, paths, binary_input)
-    ]
+    iterators = []
+    for filename, binary in zip(paths, binary_input):
+        if filename is None:
+            iterators.append(sys.stdin)
+        else:
+            packed_features = read_packed_features(filename) if binary else None
+            iterators.append(packed_features if packed_features is not None else open(filename))
 
     return zip(*iterators)
 
@@ -365,6 +717,23 @@ def random_batch_iterator(data, batch_size):
         yield random.sample(data, batch_size)
 
 
+def sequential_batch_iterator(data, batch_size):
+    """
+    Iterate once through a dataset (or any iterable) in its original order, and yield
+    batches of `batch_size` consecutive data points (the last batch may be smaller).
+
+    :param data: the dataset to segment into batches
+    :param batch_size: the size of a batch
+    :return: an iterator which yields batches (lists of data points)
+    """
+    iterator = iter(data)
+    while True:
+        batch = list(itertools.islice(iterator, batch_size))
+        if not batch:
+            break
+        yield batch
+
+
 def cycling_batch_iterator(data, batch_size):
     """
     Indefinitely cycle through a dataset and yield batches (the dataset is shuffled
@@ -406,29 +775,33 @@ def read_ahead_batch_iterator(data, batch_size, read_ahead=10):
             yield batch
 
 
+def cycling_index_iterator(size, batch_size):
+    """
+    Indefinitely cycle through the indices of a dataset, and yield batches of indices.
+    The dataset is split into blocks of `batch_size` consecutive examples, and the order
+    of these blocks is shuffled at each new epoch.
+
+    :param size: size of the dataset
+    :param batch_size: the size of a batch
+    :return: an iterator which yields int64 arrays of shape (batch_size,) (indefinitely)
+    """
+    batch_count = size // batch_size
+    while True:
+        for i in np.random.permutation(batch_count):
+            yield np.arange(i * batch_size, (i + 1) * batch_size)
+
+
 def cycling_batch_iterator_list(data, batch_size):
     """
     Indefinitely cycle through a dataset and yield batches (the dataset is shuffled
-    at each new epoch)
+    at each new epoch, see `cycling_index_iterator`)
 
-    :param data: the dataset to segment into batches
+    :param data: the dataset to segment into batches (list or `Dataset`)
     :param batch_size: the size of a batch
     :return: an iterator which yields batches (indefinitely)
     """
-    while True:
-        batch_count = len(data) // batch_size
-        pointers = np.random.permutation(batch_count)
-        debug('Pointers: {}'.format(pointers))
-        data_random = []
-        for i in range(batch_count):
-            for j in range(batch_size):
-                data_random.append(data[pointers[i] * batch_size+j])
-            #debug('Pointers i: {}'.format(pointers[i]))
-        
-
-        #random.shuffle(data) 
-        for i in range(batch_count):
-            yield data_random[i * batch_size:(i + 1) * batch_size]
+    for ids in cycling_index_iterator(len(data), batch_size):
+        yield [data[i] for i in ids]
 
 def read_binary_features_list(filename):
     """
@@ -440,18 +813,123 @@ def read_binary_features_list(filename):
     Use `scripts/extract-audio-features.py` to create such a file for audio (MFCCs).
 
     :param filename: path to the binary file containing the features
-    :return: list of arrays of shape (frames, dimension)
+    :return: float32 array of shape (frames, dimension) (only the first entry is read)
     """
+    with open(filename, 'rb') as f:
+        lines, dim, frames = np.fromfile(f, dtype=np.int32, count=3)
+        feats = np.fromfile(f, dtype=np.float32, count=frames * dim)
+
+    return feats.reshape(frames, dim)
+
+def packed_features_filename(filename):
+    """
+    Name of the packed version of a list of feature files (created by `scripts/pack-audio-features.py`)
+    """
+    return '{}.bin'.format(filename)
+
+
+def read_packed_features(filename):
+    """
+    Open the packed version of a list of feature files, if it exists and is up to date, i.e., more
+    recent than the list and than the feature files it contains. A stale packed file is ignored (with
+    a warning), so that the features are read from the list instead.
+
+    :param filename: path to the list of feature files (one path per line)
+    :return: a `BinaryFeatures`, or None
+    """
+    packed_filename = packed_features_filename(filename)
+    if not os.path.exists(packed_filename):
+        return None
+
+    with open(filename) as f:
+        paths = [line.strip() for line in f]
+
+    mtime = os.path.getmtime(packed_filename)
+    for path in [filename] + paths:
+        if os.path.exists(path) and os.path.getmtime(path) > mtime:
+            warn('ignoring {}, which is older than {} (run scripts/pack-audio-features.py again)'.format(
+                packed_filename, path))
+            return None
+
+    features = BinaryFeatures(packed_filename)
+    if len(features) != len(paths):
+        warn('ignoring {}, which does not have the same number of entries as {}'.format(packed_filename, filename))
+        return None
+    return features
+
+
+def read_feature_index(filename):
+    """
+    Read the index of a binary feature file (same format as in `read_binary_features`).
+    The index is read from `filename + '.idx'` if this file exists and is up to date,
+    otherwise it is built by skipping through the entries of the binary file.
+
+    :param filename: path to the binary file containing the features
+    :return: pair (dimension, index) where index is an array of shape (lines, 2), containing
+      the position (in number of floats from the beginning of the file) and number of frames of each entry
+    """
+    index_filename = '{}.idx'.format(filename)
 
     with open(filename, 'rb') as f:
         lines, dim = struct.unpack('ii', f.read(8))
 
-        frames, = struct.unpack('i', f.read(4))
-        n = frames * dim
-        feats = struct.unpack('f' * n, f.read(4 * n))
-        feats = np.array(feats).reshape(frames, dim)
+        if (os.path.exists(index_filename) and
+                os.path.getmtime(index_filename) >= os.path.getmtime(filename)):
+            index = np.fromfile(index_filename, dtype=np.int64).reshape(-1, 2)
+            if len(index) == lines:
+                return dim, index
+
+        index = np.zeros((lines, 2), dtype=np.int64)
+        offset = 8
+        for i in range(lines):
+            frames, = struct.unpack('i', f.read(4))
+            offset += 4
+            index[i] = offset // 4, frames
+            offset += 4 * frames * dim
+            f.seek(offset)
+
+    return dim, index
+
+
+class BinaryFeatures(object):
+    """
+    Memory-mapped binary feature file (same format as in `read_binary_features`).
+    Its entries are accessed as float32 arrays of shape (frames, dimension), which are
+    views on the file (no copy), and are only loaded into memory when they are used.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.dim, self.index = read_feature_index(filename)
+        self.data = np.memmap(filename, dtype=np.float32, mode='r')
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i):
+        offset, frames = self.index[i]
+        return self.data[offset:offset + frames * self.dim].reshape(frames, self.dim)
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
+def read_features_list(inputs, binary_input=None):
+    """
+    Load the features of the inputs which are given as paths to feature files (list layout).
+    Other inputs (token ids, sentences, or features that are already loaded) are left untouched.
+
+    :param inputs: list of inputs (one for each encoder and decoder)
+    :param binary_input: which of these inputs are binary (by default, all string inputs
+      are considered to be paths)
+    :return: list of inputs
+    """
+    binary_input = binary_input or [True] * len(inputs)
+    return [
+        read_binary_features_list(input_.strip()) if binary and isinstance(input_, str) else input_
+        for input_, binary in zip(inputs, binary_input)
+    ]
 
-    return feats
 
 def read_ahead_batch_iterator_list(data, batch_size, read_ahead=10):
     """
@@ -461,34 +939,132 @@ def read_ahead_batch_iterator_list(data, batch_size, read_ahead=10):
     This is useful for training, where all the sequences in one batch need to be padded
      to the same length as the longest sequence in the batch.
 
+    Feature files (list layout) are not loaded by this iterator, but by the consumer of the
+    batches (see `read_features_list`), which allows this loading to be done in parallel.
+
     :param data: the dataset to segment into batches
     :param batch_size: the size of a batch
     :param read_ahead: number of batches to read ahead of time and sort (larger numbers
       mean faster training, but less random behavior)
     :return: an iterator which yields batches (indefinitely)
     """
-    iterator = cycling_batch_iterator_list(data, batch_size)
-    
-    
+    iterator = cycling_index_iterator(len(data), batch_size)
+
+    if isinstance(data, Dataset):
+        lengths = data.lengths[:, -1]
+    else:
+        lengths = np.array([len(lines[-1]) for lines in data])
+
     while True:
-        batches_ = []
-        batches = [next(iterator) for _ in range(read_ahead)]
-        #debug('batches: {}'.format(len(batches)))
-        for i in range(len(batches)):
-            batches_.append([])
-            for j in range(batch_size):
-                batches_[i].append([])
-                tmp_list = batches[i][j][0]
-                #debug('i: {}'.format(i))
-                
-                batches_[i][j].append(read_binary_features_list(tmp_list.strip()))
-                batches_[i][j].append(batches[i][j][1])
-        #debug('All data: {}'.format(batches_))
-        data_ = sorted(sum(batches_, []), key=lambda lines: len(lines[-1]))
-        batches_ = [data_[i * batch_size:(i + 1) * batch_size] for i in range(read_ahead)]
-        #random.shuffle(batches_)
-        for batch in batches_:
-            yield batch
+        ids = np.concatenate([next(iterator) for _ in range(read_ahead)])
+        ids = ids[np.argsort(lengths[ids], kind='stable')]
+        for batch_ids in np.split(ids, read_ahead):
+            yield [data[i] for i in batch_ids]
+
+
+def token_batch_iterator(data, batch_tokens, max_lengths=None):
+    """
+    Indefinitely cycle through a dataset, and yield batches of examples of similar lengths,
+    whose size is limited by a number of tokens instead of a number of examples.
+
+    The examples are sorted by length (the maximum length of their inputs, in tokens or frames),
+    and this order is cut greedily into batches of at most `batch_tokens` tokens (padding
+    included, see `split_token_batches`). The order of the examples of the same length, and
+    the order of the batches are shuffled at each new epoch.
+
+    :param data: the dataset to segment into batches (list or `Dataset`)
+    :param batch_tokens: maximum number of tokens in a batch, for each input (an example
+      which is longer than that forms a batch on its own)
+    :param max_lengths: maximum length of each input (longer inputs are truncated in the batches)
+    :return: an iterator which yields batches (indefinitely)
+    """
+    if isinstance(data, Dataset):
+        lengths = data.lengths
+    else:
+        lengths = np.array([[len(input_) for input_ in inputs] for inputs in data])
+
+    if max_lengths is not None:
+        max_lengths = [np.iinfo(lengths.dtype).max if len_ is None else len_ for len_ in max_lengths]
+        lengths = np.minimum(lengths, max_lengths)
+
+    lengths = np.max(lengths, axis=1)
+
+    while True:
+        ids = np.random.permutation(len(lengths))
+        ids = ids[np.argsort(lengths[ids], kind='stable')]
+        batches = [ids[start:end] for start, end in split_token_batches(lengths[ids], batch_tokens)]
+
+        for i in np.random.permutation(len(batches)):
+            yield [data[j] for j in batches[i]]
+
+
+def split_token_batches(sorted_lengths, batch_tokens):
+    """
+    Cut a sequence of examples sorted by increasing length into consecutive batches, which are
+    as large as possible while `batch_size * max_length <= batch_tokens`.
+
+    :param sorted_lengths: lengths of the examples, in increasing order
+    :param batch_tokens: maximum number of tokens in a batch (an example which is longer than
+      that forms a batch on its own)
+    :return: list of (start, end) positions of the batches
+    """
+    boundaries = []
+    start = 0
+    while start < len(sorted_lengths):
+        end = start + 1
+        # the last example of the batch is the longest one
+        while end < len(sorted_lengths) and (end + 1 - start) * sorted_lengths[end] <= batch_tokens:
+            end += 1
+        boundaries.append((start, end))
+        start = end
+    return boundaries
+
+
+def prefetch_iterator(iterator, size, workers=1, func=None):
+    """
+    Read items from `iterator` ahead of time in background threads, and optionally transform
+    them with `func` (e.g. to load features and pad the batches). Those threads release the GIL
+    in I/O and numpy operations, so this work overlaps with the TensorFlow session.
+
+    :param iterator: the iterator to read from (it does not need to be thread-safe)
+    :param size: maximum number of items that are read ahead of time
+    :param workers: number of background threads
+    :param func: function applied to each item by the background threads
+    :return: an iterator over the (transformed) items. When there are several workers, items
+      are not necessarily yielded in the same order as `iterator`.
+    """
+    queue_ = queue.Queue(maxsize=size)
+    lock = threading.Lock()
+
+    def load():
+        while True:
+            try:
+                with lock:
+                    item = next(iterator)
+                if func is not None:
+                    item = func(item)
+            except StopIteration:
+                queue_.put((None, StopIteration()))
+                return
+            except Exception as e:  # exceptions are raised in the main thread
+                queue_.put((None, e))
+                return
+            queue_.put((item, None))
+
+    for _ in range(workers):
+        thread = threading.Thread(target=load)
+        thread.daemon = True
+        thread.start()
+
+    finished = 0
+    while finished < workers:
+        item, exception = queue_.get()
+        if isinstance(exception, StopIteration):
+            finished += 1
+        elif exception is not None:
+            raise exception
+        else:
+            yield item
 
 
 def get_batches(data, batch_size, batches=10, allow_smaller=True):
@@ -540,16 +1116,8 @@ def get_batches_list(data, batch_size, batches=10, allow_smaller=True):
 
     if batches < 1 or batches > max_batches:
         batches = max_batches
-        
-    random.shuffle(data)
-    data_ = []
-  
-    for i in range(len(data)):
-        data_.append([])
-        tmp_list = data[i][0]
-        #debug('i: {}'.format(i))
-        data_[i].append(read_binary_features_list(tmp_list.strip()))
-        data_[i].append(data[i][1])
+
+    data_ = [read_features_list(data[i]) for i in np.random.permutation(len(data))[:batches * batch_size]]
 
     #debug('All dev data: {}'.format(len(data_)))
 
@@ -557,15 +1125,26 @@ def get_batches_list(data, batch_size, batches=10, allow_smaller=True):
     return batch
 
 
-def read_lines(paths, extensions, binary_input=None):
+def read_lines(paths, extensions, binary_input=None, stream=False):
+    """
+    Read the corresponding lines of several files (one for each extension).
+
+    :param paths: paths to the files (if empty, read from standard input)
+    :param extensions: extension of each file
+    :param binary_input: which of these files contain binary features
+    :param stream: read the binary features sequentially (see `iter_binary_features`) instead of
+      memory-mapping the files (see `BinaryFeatures`)
+    :return: iterator of tuples of lines (one element for each file)
+    """
     binary_input = binary_input or [False] * len(extensions)
+    read_features = iter_binary_features if stream else functools.partial(read_binary_features, lazy=True)
 
     if not paths:  # read from stdin (only works with one encoder with text input)
         assert len(extensions) == 1 and not any(binary_input)
         paths = [None]
 
     iterators = [
-        sys.stdin if filename is None else read_binary_features(filename) if binary else open(filename)
+        sys.stdin if filename is None else read_features(filename) if binary else open(filename)
         for ext, filename, binary in zip(extensions, paths, binary_input)
     ]
 
@@ -582,33 +1161,80 @@ def read_ngrams(lm_path, vocab):
     :return: one dict for each ngram order, containing mappings from
       ngram (as a sequence of token ids) to (log probability, backoff weight)
     """
-    ngram_list = []
+    ngrams = []
+    mappings = {'<s>': _BOS, '</s>': _EOS, '<unk>': _UNK}
+
     with open(lm_path) as f:
         for line in f:
             line = line.strip()
             if re.match(r'\\\d-grams:', line):
-                ngram_list.append({})
+                ngrams.append({})
             elif not line or line == '\\end\\':
                 continue
-            elif ngram_list:
+            elif ngrams:
                 arr = list(map(str.rstrip, line.split('\t')))
-                ngram = arr.pop(1)
-                ngram_list[-1][ngram] = list(map(float, arr))
+                seq = arr.pop(1)
+                # n-grams are directly mapped to token ids (n-grams with unknown words are skipped)
+                ids = tuple(vocab.get(mappings.get(w, w)) for w in seq.split())
+                if any(id_ is None for id_ in ids):
+                    continue
+                ngrams[-1][ids] = list(map(float, arr))
+
+    debug('loaded n-grams, order={}'.format(len(ngrams)))
+    return ngrams
 
-    debug('loaded n-grams, order={}'.format(len(ngram_list)))
 
-    ngrams = []
-    mappings = {'<s>': _BOS, '</s>': _EOS, '<unk>': _UNK}
+def read_language_model(lm_path, vocab, cache_size=64):
+    """
+    Load a language model in the ARPA format as a `NGramLanguageModel`.
 
-    for kgrams in ngram_list:
-        d = {}
-        for seq, probas in kgrams.items():
-            ids = tuple(vocab.get(mappings.get(w, w)) for w in seq.split())
-            if any(id_ is None for id_ in ids):
-                continue
-            d[ids] = probas
-        ngrams.append(d)
-    return ngrams
+    The first time a language model is loaded (with a given vocabulary), it is converted
+    to a binary file (`LM_PATH.VOCAB_HASH.bin`), which is memory-mapped by the next calls.
+
+    :param lm_path: full path to language model file
+    :param vocab: vocabulary used to map words from the LM to token ids
+    :param cache_size: number of score rows cached by the model (see `NGramLanguageModel`)
+    :return: a `NGramLanguageModel`
+    """
+    vocab_hash = hash_vocabulary(vocab)
+    cache_path = '{}.{}.bin'.format(lm_path, vocab_hash[:10])
+    stat = os.stat(lm_path)
+    key = dict(source_size=stat.st_size, source_mtime=stat.st_mtime, vocab_hash=vocab_hash)
+
+    if os.path.exists(cache_path):
+        arrays, meta = load_arrays(cache_path)
+        if all(meta.get(k) == v for k, v in key.items()):
+            debug('loading language model from {}'.format(cache_path))
+            return NGramLanguageModel.from_arrays(arrays, cache_size=cache_size)
+
+    lm = NGramLanguageModel.from_ngrams(read_ngrams(lm_path, vocab), cache_size=cache_size)
+
+    try:
+        save_arrays(cache_path, lm.to_arrays(), **key)
+        debug('saved language model to {}'.format(cache_path))
+    except IOError:
+        warn('could not save language model to {}'.format(cache_path))
+
+    return lm
+
+
+def write_metrics(metrics_file, **metrics):
+    """
+    Append a JSON line with these metrics (and a time stamp) to `metrics_file`
+
+    :param metrics_file: path to the metrics file (nothing is written if None)
+    :param metrics: values to write (numpy scalars are converted to Python numbers)
+    """
+    if metrics_file is None:
+        return
+
+    def convert(value):
+        if isinstance(value, np.generic):
+            return value.item()
+        raise TypeError('{!r} is not JSON serializable'.format(value))
+
+    with open(metrics_file, 'a') as f:
+        f.write(json.dumps(dict(time_stamp=time.time(), **metrics), default=convert) + '\n')
 
 
 def create_logger(log_file=None):
@@ -668,6 +1294,157 @@ def estimate_lm_score(sequence, ngrams):
         return estimate_lm_score(sequence[1:], ngrams) + backoff_weight
 
 
+class NGramLanguageModel(object):
+    """
+    Compiled version of the n-gram language model returned by `read_ngrams`, which computes
+    the scores of all the words in the vocabulary at once (same scores as `estimate_lm_score`).
+
+    The model is only made of arrays, which can be saved to a file and memory-mapped (see
+    `read_language_model`). For each order k, the contexts of length k (which have a backoff weight,
+    or which are the prefix of a (k+1)-gram) are sorted, and their index in this sorted array is
+    their id (contexts are found by binary search). This id indexes an array of backoff weights,
+    and a contiguous range in the arrays of (word id, log probability) of the (k+1)-grams starting
+    with this context. The score rows of the most recently used histories are cached (each row
+    is a float32 array of the size of the vocabulary, i.e., 160 KB for 40k words).
+    """
+
+    def __init__(self, contexts, backoff, offsets, words, probs, cache_size=64):
+        """
+        :param contexts: for each order k, int32 array of shape (contexts, k) (sorted)
+        :param backoff: for each order, float32 array of the backoff weight of each context
+        :param offsets: for each order, int64 array of the position of each context in `words`
+          and `probs` (with an additional end position)
+        :param words: for each order, int32 array of the word ids of the n-grams, grouped by context
+        :param probs: for each order, float32 array of the log probabilities of the n-grams
+        :param cache_size: maximum number of score rows in the cache (0 to disable the cache)
+        """
+        self.order = len(contexts)
+        self.contexts = contexts
+        self.backoff = backoff
+        self.offsets = offsets
+        self.words = words
+        self.probs = probs
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+    @classmethod
+    def from_ngrams(cls, ngrams, **kwargs):
+        """
+        :param ngrams: list of dicts, as returned by `read_ngrams`
+        """
+        contexts, backoff, offsets, words, probs = [], [], [], [], []
+
+        for k, kgrams in enumerate(ngrams):
+            contexts_ = set(seq[:-1] for seq in kgrams)
+            if k > 0:
+                contexts_.update(ngrams[k - 1])
+            contexts_ = sorted(contexts_)
+            context_ids = dict((context, i) for i, context in enumerate(contexts_))
+
+            backoff_ = np.zeros(len(contexts_), dtype=np.float32)
+            if k > 0:
+                for seq, weights in ngrams[k - 1].items():
+                    if len(weights) > 1:
+                        backoff_[context_ids[seq]] = weights[1]
+
+            entries = sorted((context_ids[seq[:-1]], seq[-1], weights[0]) for seq, weights in kgrams.items())
+            entry_contexts = np.array([context_id for context_id, _, _ in entries], dtype=np.int64)
+
+            contexts.append(np.array(contexts_, dtype=np.int32).reshape(len(contexts_), k))
+            backoff.append(backoff_)
+            offsets.append(np.searchsorted(entry_contexts, np.arange(len(contexts_) + 1)).astype(np.int64))
+            words.append(np.array([word for _, word, _ in entries], dtype=np.int32))
+            probs.append(np.array([prob for _, _, prob in entries], dtype=np.float32))
+
+        return cls(contexts, backoff, offsets, words, probs, **kwargs)
+
+    @classmethod
+    def from_arrays(cls, arrays, **kwargs):
+        """
+        :param arrays: dict of arrays, as returned by `to_arrays`
+        """
+        order = len([name for name in arrays if name.startswith('contexts_')])
+        fields = ['contexts', 'backoff', 'offsets', 'words', 'probs']
+        return cls(*[[arrays['{}_{}'.format(field, k)] for k in range(order)] for field in fields], **kwargs)
+
+    def to_arrays(self):
+        arrays = {}
+        for field in ['contexts', 'backoff', 'offsets', 'words', 'probs']:
+            for k, array_ in enumerate(getattr(self, field)):
+                arrays['{}_{}'.format(field, k)] = array_
+        return arrays
+
+    def __len__(self):
+        return self.order
+
+    def _context_id(self, history):
+        """
+        Binary search of `history` in the sorted contexts of the same length.
+        Returns None if this history is not a context.
+        """
+        contexts = self.contexts[len(history)]
+        low, high = 0, len(contexts)
+        for j, token_id in enumerate(history):
+            column = contexts[low:high, j]
+            low, high = (low + np.searchsorted(column, token_id, side='left'),
+                         low + np.searchsorted(column, token_id, side='right'))
+            if low == high:
+                return None
+        return low if low < high else None
+
+    def _row(self, history, vocab_size):
+        """
+        Log probabilities of all the words in the vocabulary after `history`
+        (recursive definition with backoff, as in `estimate_lm_score`).
+        """
+        key = (vocab_size, history)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+
+        k = len(history)
+        if k == 0:
+            row = np.full(vocab_size, float('-inf'), dtype=np.float32)
+        else:
+            row = self._row(history[1:], vocab_size).copy()
+
+        context_id = self._context_id(history)
+        if context_id is not None:
+            row += self.backoff[k][context_id]
+            start, end = self.offsets[k][context_id:context_id + 2]
+            words, probs = self.words[k][start:end], self.probs[k][start:end]
+            mask = words < vocab_size
+            row[words[mask]] = probs[mask]
+
+        self.cache[key] = row
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return row
+
+    def scores(self, hypotheses, vocab_size):
+        """
+        Compute the LM score of each possible next word, for a list of hypotheses.
+
+        :param hypotheses: list of hypotheses (lists of token ids, without the BOS symbol)
+        :param vocab_size: size of the target vocabulary
+        :return: array of shape (len(hypotheses), vocab_size) of log probabilities.
+          Words which are not in the unigrams, and the BOS symbol get a score of -inf.
+        """
+        unigrams = np.zeros(vocab_size, dtype=np.bool_)
+        words = self.words[0]
+        unigrams[words[words < vocab_size]] = True
+        unigrams[BOS_ID] = False
+
+        scores = np.full((len(hypotheses), vocab_size), float('-inf'), dtype=np.float32)
+        for i, hypothesis in enumerate(hypotheses):
+            # not sure about this (should we put <s> at the beginning?)
+            hypothesis = [BOS_ID] + list(hypothesis)
+            history = tuple(hypothesis[max(0, len(hypothesis) - self.order + 1):])
+            scores[i, unigrams] = self._row(history, vocab_size)[unigrams]
+
+        return scores
+
+
 def heatmap(xlabels=None, ylabels=None, weights=None,
             output_file=None, wav_file=None):
     """